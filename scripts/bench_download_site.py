@@ -0,0 +1,343 @@
+"""
+Benchmark for download_site.SiteMirror against a synthetic local site.
+
+A generated site is served from a separate process on 127.0.0.1, then
+SiteMirror.run mirrors it into a temp directory and the run is measured:
+  - pages/s and bytes/s (bytes written under OUTPUT_DIR)
+  - peak RSS of the mirroring process
+  - seconds per phase (wait, fetch, parse, write, relink), summed over
+    all workers, as recorded in SiteMirror.timings
+
+The site shape is configurable (page count, link depth, asset fan-out,
+CSS url() density, file sizes) and the server can inject latency and
+429 responses. Each run prints one JSON line tagged with the current git
+commit; append them to a file with --json to compare commits.
+
+Example:
+  python scripts/bench_download_site.py --pages 500 --assets 20 --engine async
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:         # Windows: no getrusage, peak RSS is not reported
+    resource = None
+
+import download_site
+
+
+# ---------------------------------------------------------------------------
+# Synthetic site
+# ---------------------------------------------------------------------------
+
+class SyntheticSite:
+    """
+    A deterministic site generated on the fly.
+
+    Pages form a tree: page i links to pages i*fanout+1 … i*fanout+fanout
+    (up to *pages*), plus a link back to the home page. Every page
+    references *assets* images and one stylesheet out of *stylesheets*;
+    each stylesheet has *css_urls* url() references into the same image
+    pool, so assets are shared between pages like on a real site.
+    """
+
+    def __init__(self, pages, fanout, assets, stylesheets, css_urls,
+                 asset_size, page_padding, seed):
+        self.pages = pages
+        self.fanout = fanout
+        self.assets = assets
+        self.stylesheets = stylesheets
+        self.css_urls = css_urls
+        self.asset_size = asset_size
+        self.page_padding = page_padding
+        self.seed = seed
+        self.image_pool = max(assets * 4, 1)
+
+    def depth_of(self, page: int) -> int:
+        depth = 0
+        while page:
+            page = (page - 1) // self.fanout
+            depth += 1
+        return depth
+
+    def page(self, i: int) -> bytes:
+        rnd = random.Random(self.seed * 1_000_003 + i)
+        children = range(i * self.fanout + 1,
+                         min(i * self.fanout + self.fanout, self.pages - 1) + 1)
+        links = "".join(f'<li><a href="/p/{c}.html">page {c}</a></li>'
+                        for c in children)
+        images = "".join(
+            f'<img src="/img/{rnd.randrange(self.image_pool)}.png" alt="">'
+            for _ in range(self.assets)
+        )
+        css = rnd.randrange(self.stylesheets)
+        padding = "<p>" + "lorem ipsum " * (self.page_padding // 12) + "</p>"
+        return (
+            "<!DOCTYPE html><html><head>"
+            f"<title>Page {i}</title>"
+            f'<link rel="stylesheet" href="/css/{css}.css">'
+            "</head><body>"
+            f'<nav><a href="/">home</a></nav><ul>{links}</ul>'
+            f"{images}{padding}"
+            "</body></html>"
+        ).encode()
+
+    def stylesheet(self, k: int) -> bytes:
+        rnd = random.Random(self.seed * 7919 + k)
+        rules = "".join(
+            f".c{k}-{n}{{background:url(/img/{rnd.randrange(self.image_pool)}.png)}}\n"
+            for n in range(self.css_urls)
+        )
+        return rules.encode()
+
+    def image(self, j: int) -> bytes:
+        return random.Random(self.seed * 31 + j).randbytes(self.asset_size)
+
+    def resolve(self, path: str) -> tuple[bytes, str] | None:
+        """Return (body, content type) for *path*, or None for a 404."""
+        try:
+            if path in ("/", "/index.html"):
+                return self.page(0), "text/html; charset=utf-8"
+            if path.startswith("/p/") and path.endswith(".html"):
+                i = int(path[3:-5])
+                if 0 <= i < self.pages:
+                    return self.page(i), "text/html; charset=utf-8"
+            if path.startswith("/css/") and path.endswith(".css"):
+                k = int(path[5:-4])
+                if 0 <= k < self.stylesheets:
+                    return self.stylesheet(k), "text/css"
+            if path.startswith("/img/") and path.endswith(".png"):
+                j = int(path[5:-4])
+                if 0 <= j < self.image_pool:
+                    return self.image(j), "image/png"
+        except ValueError:
+            pass
+        return None
+
+
+def _serve(site: SyntheticSite, port_queue, latency: float,
+           error_rate: float, retry_after: int):
+    """Server process: serve *site* until terminated."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Send headers and body in one segment; otherwise Nagle plus
+        # delayed ACKs add ~40 ms to every keep-alive request
+        disable_nagle_algorithm = True
+        wbufsize = 64 * 1024
+        rnd = random.Random(site.seed)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            if error_rate and self.rnd.random() < error_rate:
+                self.send_response(429)
+                self.send_header("Retry-After", str(retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            found = site.resolve(self.path.split("?", 1)[0])
+            if found is None:
+                self.send_error(404)
+                return
+            body, content_type = found
+            etag = f'"{zlib.crc32(body):08x}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def _tree_size(root: str) -> tuple[int, int]:
+    """(number of .html files, total bytes) under *root*, skipping dotfiles."""
+    pages = size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in filenames:
+            if name.startswith("."):
+                continue
+            size += os.path.getsize(os.path.join(dirpath, name))
+            pages += name.endswith(".html")
+    return pages, size
+
+
+def run_once(start_url: str, output_dir: str, verbose: bool) -> dict:
+    """Mirror *start_url* into *output_dir* and return the measurements."""
+    download_site.OUTPUT_DIR = output_dir
+    mirror = download_site.SiteMirror()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            devnull = stack.enter_context(open(os.devnull, "w"))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        start = time.perf_counter()
+        summary = mirror.run(start_url)
+        elapsed = time.perf_counter() - start
+    pages, size = _tree_size(output_dir)
+    return {
+        "seconds": round(elapsed, 3),
+        "pages": pages,
+        "files": len(mirror.saved),
+        "bytes": size,
+        "pages_per_s": round(pages / elapsed, 2),
+        "bytes_per_s": round(size / elapsed),
+        "phases": {k: round(v, 3) for k, v in mirror.timings.items()},
+        "requests": summary["requests_by_status"],
+        "retries": summary["retries"],
+        "dedup_hits": summary["dedup_hits"],
+        "connection_reuse": summary["transport"]["reuse_ratio"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    site = parser.add_argument_group("synthetic site")
+    site.add_argument("--pages", type=int, default=200)
+    site.add_argument("--fanout", type=int, default=5, help="links per page")
+    site.add_argument("--depth", type=int, default=None,
+                      help="MAX_DEPTH for the mirror (default: whole tree)")
+    site.add_argument("--assets", type=int, default=10, help="images per page")
+    site.add_argument("--stylesheets", type=int, default=5)
+    site.add_argument("--css-urls", type=int, default=20,
+                      help="url() references per stylesheet")
+    site.add_argument("--asset-size", type=int, default=16 * 1024)
+    site.add_argument("--page-padding", type=int, default=4 * 1024,
+                      help="bytes of filler text per page")
+    site.add_argument("--latency", type=float, default=0.0,
+                      help="seconds of server latency per request")
+    site.add_argument("--error-rate", type=float, default=0.0,
+                      help="fraction of requests answered with 429")
+    site.add_argument("--retry-after", type=int, default=0,
+                      help="Retry-After seconds sent with injected 429s")
+    site.add_argument("--seed", type=int, default=1)
+    mirror = parser.add_argument_group("mirror")
+    mirror.add_argument("--engine", choices=("sync", "async"), default="sync")
+    mirror.add_argument("--page-workers", type=int,
+                        default=download_site.PAGE_WORKERS)
+    mirror.add_argument("--asset-workers", type=int,
+                        default=download_site.ASSET_WORKERS)
+    mirror.add_argument("--parser", default=download_site.PARSER_BACKEND)
+    mirror.add_argument("--parse-processes", type=int, default=0)
+    mirror.add_argument("--delay", type=float, nargs=2, default=(0.0, 0.0),
+                        metavar=("MIN", "MAX"), help="REQUEST_DELAY range")
+    mirror.add_argument("--host-inflight", type=int, default=4,
+                        help="HOST_MAX_INFLIGHT (everything is one host here)")
+    mirror.add_argument("--adaptive", action="store_true",
+                        help="ADAPTIVE_CONCURRENCY (start at --host-inflight)")
+    mirror.add_argument("--transport", choices=("requests", "httpx"),
+                        default=download_site.TRANSPORT, help="TRANSPORT")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="runs into the same directory (later runs are warm)")
+    parser.add_argument("--json", metavar="FILE",
+                        help="append one JSON line per run to FILE")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show SiteMirror output")
+    parser.add_argument("--progress", type=float, default=0.0, metavar="SECONDS",
+                        help="SiteMirror progress line on stderr every SECONDS")
+    args = parser.parse_args()
+    if args.parse_processes and args.engine != "async":
+        parser.error("--parse-processes needs --engine async")
+
+    synthetic = SyntheticSite(args.pages, args.fanout, args.assets,
+                              args.stylesheets, args.css_urls, args.asset_size,
+                              args.page_padding, args.seed)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=_serve, daemon=True,
+        args=(synthetic, port_queue, args.latency, args.error_rate,
+              args.retry_after),
+    )
+    server.start()
+    port = port_queue.get(timeout=10)
+    host = f"127.0.0.1:{port}"
+
+    download_site.ALLOWED_DOMAINS = {host}
+    download_site.MAX_DEPTH = (args.depth if args.depth is not None
+                               else synthetic.depth_of(args.pages - 1))
+    download_site.REQUEST_DELAY = tuple(args.delay)
+    download_site.HOST_MAX_INFLIGHT = args.host_inflight
+    download_site.ADAPTIVE_CONCURRENCY = args.adaptive
+    download_site.TRANSPORT = args.transport
+    download_site.ENGINE = args.engine
+    download_site.PAGE_WORKERS = args.page_workers
+    download_site.ASSET_WORKERS = args.asset_workers
+    download_site.PARSER_BACKEND = args.parser
+    download_site.PARSE_PROCESSES = args.parse_processes
+    download_site.PROGRESS_INTERVAL = args.progress
+
+    workdir = tempfile.mkdtemp(prefix="bench-sitemirror-")
+    output_dir = os.path.join(workdir, "output")
+    download_site.STATE_FILE = os.path.join(workdir, "state.sqlite")
+    config = {k: v for k, v in vars(args).items()
+              if k not in ("json", "verbose", "runs", "progress")}
+    try:
+        for run in range(1, args.runs + 1):
+            result = {
+                "commit": _git_revision(),
+                "run": run,
+                **run_once(f"http://{host}/", output_dir, args.verbose),
+                "peak_rss_mb": _peak_rss_mb(),
+                "config": config,
+            }
+            line = json.dumps(result)
+            print(line)
+            if args.json:
+                with open(args.json, "a", encoding="utf-8") as fh:
+                    fh.write(line + "\n")
+    finally:
+        server.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
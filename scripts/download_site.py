@@ -5,37 +5,162 @@ Recursive website downloader — similar to:
        --domains=example.com --no-parent <url>
 
 Features:
-  - Recursively follows same-domain links up to a configurable depth.
+  - Recursively follows same-domain links up to a configurable depth,
+    optionally narrowed by path include/exclude patterns.
   - Downloads page requisites (CSS, JS, images, fonts, etc.) regardless
     of which (sub)domain they live on, so pages render correctly offline.
   - Rewrites every URL reference in saved HTML/CSS to point at the local
     copy, so the mirror works when opened from disk.
   - Windows-safe filenames (no special chars, adds .html extension).
+  - Optional asyncio engine (--engine async) that runs several page and
+    asset workers at once instead of fetching one URL at a time.
 """
 
+import io
 import re
 import os
 import sys
+import math
 import time
+import json
+import uuid
+import zlib
+import base64
 import random
+import socket
+import shutil
+import struct
+import sqlite3
+import asyncio
+import heapq
+import fnmatch
 import hashlib
+import argparse
+import gzip
+import zipfile
+import tempfile
+import threading
+import multiprocessing
+import mimetypes
+import xml.etree.ElementTree as ET
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from collections import deque
-from urllib.parse import urljoin, urlparse, urlunparse, unquote
+from itertools import count
+from contextlib import contextmanager
+from html import unescape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import (urljoin, urlparse, urlsplit, urlunparse, urlunsplit,
+                          unquote, quote)
+from urllib.robotparser import RobotFileParser
 
 import requests
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import RequestHistory, Retry
 from bs4 import BeautifulSoup
 
+try:                        # optional C parsers, see PARSER_BACKEND
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+try:
+    import lxml  # noqa: F401  (enables BeautifulSoup's "lxml" tree builder)
+    _HAVE_LXML = True
+except ImportError:
+    _HAVE_LXML = False
+try:                        # optional HTTP/2 client, see TRANSPORT
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2  # noqa: F401  (enables httpx's HTTP/2 support)
+    _HAVE_H2 = True
+except ImportError:
+    _HAVE_H2 = False
+
 # ---------------------------------------------------------------------------
 # Configuration
 # ---------------------------------------------------------------------------
 START_URL = "https://example.com/"
 OUTPUT_DIR = "output"
 MAX_DEPTH = 2                       # link-follow depth (0 = start page only)
-ALLOWED_DOMAINS = {"example.com"}  # only follow links on these domains
-REQUEST_TIMEOUT = 30                # seconds
-REQUEST_DELAY = (0.5, 1.5)         # random delay range (seconds) between requests
+ALLOWED_DOMAINS = {"example.com"}  # only follow links on these domains (and their subdomains)
+SCOPE_INCLUDE: list[str] = []       # regexes; a page's path (and query) must match one (empty = any)
+SCOPE_EXCLUDE: list[str] = []       # regexes; pages whose path matches one are not followed
+CANONICAL_RULES = {                 # built-in URL canonicalisation rules (see UrlCanonicaliser)
+    "scheme", "host", "default_port", "percent_encoding", "index_pages",
+    "tracking_params", "session_ids", "sort_query",
+}
+TRACKING_PARAMS = ["utm_*", "gclid", "dclid", "fbclid", "msclkid", "yclid",
+                   "mc_cid", "mc_eid", "_ga", "_gl", "igshid"]  # glob patterns, any case
+SESSION_PARAMS = ["jsessionid", "phpsessid", "aspsessionid*", "sessionid",
+                  "session_id", "cfid", "cftoken"]
+INDEX_PAGES = ["index.html", "index.htm", "index.php", "default.htm",
+               "default.html", "default.aspx"]  # served for their directory's URL
+SITE_URL_RULES: dict[str, dict] = {}  # per-domain extra rules, e.g. {"example.com":
+                                    #   {"drop_params": ["sort"], "keep_params": [...],
+                                    #    "rewrite": [(r"/amp/", "/")]}}
+CONNECT_TIMEOUT = 10                # seconds to open a connection
+REQUEST_TIMEOUT = 30                # seconds to wait for the next bytes of a response
+REQUEST_DEADLINE = 120              # seconds one request may take, retries and body included (None = no limit)
+BREAKER_FAILURES = 5                # failed requests in a row that pause a host (0 = never)
+BREAKER_COOLDOWN = 60               # seconds a paused host is skipped before one trial request
+REQUEST_DELAY = (0.5, 1.5)         # random delay range (seconds) between requests to a host
+HOST_DELAYS: dict[str, tuple[float, float]] = {}  # per-host REQUEST_DELAY overrides
+HOST_MAX_INFLIGHT = 1               # concurrent requests allowed per host
+TRANSPORT = "requests"              # "requests" (urllib3, HTTP/1.1) or "httpx" (HTTP/2 if h2 is installed)
+POOL_SIZE = None                    # pooled connections per host (None = one per worker, at least 10)
+POOL_HOSTS = 100                    # hosts whose connection pools are kept open at once
+KEEPALIVE_EXPIRY = 30.0             # seconds an idle pooled connection is kept (httpx; urllib3 keeps
+                                    # them until the server closes them)
+DNS_CACHE_TTL = 300                 # seconds a resolved address is reused in-process (0 = off)
+ADAPTIVE_CONCURRENCY = False        # tune each host's in-flight limit from 429/503s and latency
+ADAPTIVE_MAX_INFLIGHT = 16          # upper bound for that limit (HOST_MAX_INFLIGHT is the start)
+ADAPTIVE_LATENCY_SPIKE = 2.0        # p50 over this multiple of the best p50 counts as overload
+DOWNLOAD_CHUNK_SIZE = 64 * 1024     # bytes per write when streaming a download
+MAX_FILE_SIZE = 512 * 1024 * 1024   # skip files larger than this (None = no cap)
+CONDITIONAL_REQUESTS = True         # revalidate files from earlier runs (ETag / Last-Modified)
+METADATA_FILE = ".sitemirror-meta.json"  # per-URL validators of older versions, in OUTPUT_DIR;
+                                    # moved into the STATE_FILE on the next run
+STATE_FILE = None                   # crawl state for --resume and per-URL validators (None = "<OUTPUT_DIR>.state.sqlite")
+CHECKPOINT_EVERY = 50               # finished pages between crawl-state commits
+RESUME = False                      # continue the crawl recorded in STATE_FILE
+BLOB_STORE = False                  # dedup identical downloads via OUTPUT_DIR/.blobs
+BLOB_LINK = "hardlink"              # how URL paths point at blobs: "hardlink" or "symlink"
+BLOB_MEMORY_LIMIT = 1024 * 1024     # bodies up to this size are hashed before any write
+ROBOTS_TXT = False                  # skip pages disallowed for "*" by each host's robots.txt
+SITEMAPS = False                    # seed the frontier from the start host's sitemaps
+SITEMAP_DEPTH = 1                   # depth given to sitemap URLs (as if the start page linked them)
+ARCHIVE_FILE = None                 # pack the mirror into this zip instead of a file tree (None = off)
+PARSER_BACKEND = "auto"             # "auto", "lexbor" (selectolax), "lxml", "stream" or "html.parser"
+PARSE_PROCESSES = 0                 # worker processes for parse/rewrite (0 = in the fetching thread;
+                                    # async engine only: the sync engine parses one page at a time)
+FRONTIER_MEMORY = 100_000           # frontier entries kept in RAM; the rest spills to files under OUTPUT_DIR
+FRONTIER_ORDER = "fifo"             # "fifo" (discovery order) or "priority" (see PriorityFrontier)
+PRIORITY_PATTERNS: list[tuple[str, float]] = []  # (regex, weight) added to matching URLs' scores
+PRIORITY_CHANGE_WEIGHT = 1.0        # score per unit of a page's observed change rate
+PRIORITY_HOST_WEIGHT = 0.5          # score lost per log(1 + pages already queued from the host)
+TIME_BUDGET = None                  # stop taking new pages after this many seconds (None = no limit)
+BYTE_BUDGET = None                  # ... or once this many bytes were received (None = no limit)
+PAGE_BUDGET = None                  # ... or after this many pages (None = no limit)
+HOST_PAGE_BUDGET = None             # skip a host's pages after this many (None = no limit)
+HOST_BYTE_BUDGET = None             # skip a host's pages and files past this many bytes received
+SKIPPED_FILE = ".sitemirror-skipped.jsonl"  # URLs left out by budgets / MAX_FILE_SIZE / paused hosts, in OUTPUT_DIR
+VISITED_SET = "fingerprint"         # "fingerprint" (64-bit hashes), "bloom" or "exact" (set of str)
+BLOOM_CAPACITY = 10_000_000         # URLs the "bloom" visited set is sized for
+BLOOM_ERROR_RATE = 0.001            # its false-positive rate up to that capacity
+WARC_DIR = None                     # also record every HTTP exchange as WARC files here (None = off)
+WARC_PREFIX = "sitemirror"          # WARC / CDX file name prefix
+WARC_MAX_SIZE = 1024 ** 3           # start a new .warc.gz once the current one reaches this
+PROGRESS_INTERVAL = 0               # seconds between progress lines on stderr (0 = off)
+SUMMARY_FILE = ".sitemirror-summary.json"  # JSON run metrics, written inside OUTPUT_DIR
+PROMETHEUS_FILE = None              # also write metrics here (node exporter textfile format)
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
@@ -43,6 +168,10 @@ USER_AGENTS = [
     "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0",
 ]
+ENGINE = "sync"                     # "sync" (one URL at a time) or "async"
+PAGE_WORKERS = 8                    # concurrent page workers (async engine)
+ASSET_WORKERS = 16                  # concurrent requisite downloads (both engines)
+CSS_WORKERS = 16                    # concurrent downloads of what stylesheets reference
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -61,6 +190,8 @@ def url_to_local_path(url: str) -> str:
     """
     Convert a URL into a safe local filepath under OUTPUT_DIR.
 
+    - Works on the canonical form (see UrlCanonicaliser), so variants of
+      one URL share a file.
     - Strips the scheme.
     - Keeps the netloc (domain) as the first directory so assets from
       different domains don't collide.
@@ -68,7 +199,7 @@ def url_to_local_path(url: str) -> str:
     - Query strings / fragments are hashed into the filename to keep
       distinct pages separate.
     """
-    parsed = urlparse(url)
+    parsed = urlparse(canonical_url(url))
     netloc = _sanitise_path_component(parsed.netloc or "unknown")
     raw_path = unquote(parsed.path).strip("/")
 
@@ -95,287 +226,3553 @@ def _ensure_html_extension(path: str) -> str:
     return path
 
 
-def _is_same_domain(url: str) -> bool:
-    """Check whether a URL belongs to one of the ALLOWED_DOMAINS."""
-    netloc = urlparse(url).netloc.lower()
-    return any(netloc == d or netloc.endswith("." + d) for d in ALLOWED_DOMAINS)
+class CrawlScope:
+    """
+    Which discovered pages are followed: ALLOWED_DOMAINS, SCOPE_INCLUDE
+    and SCOPE_EXCLUDE, compiled once so a decision costs about one pass
+    over the URL however many rules there are.
 
+    Domains go into a trie keyed by label from the right ("com" ->
+    "example" -> "www"); a host is allowed if its walk down the trie
+    passes the end of an allowed domain, so hundreds of subdomains cost
+    no more than one. The path rules are a single regex: the exclude
+    patterns are tried first, so an excluded path is out even when it
+    also matches an include pattern.
+    """
 
-def _normalise_url(url: str) -> str:
-    """Strip fragment and trailing slash for de-duplication."""
+    _END = ""                           # trie key marking an allowed domain
+
+    def __init__(self):
+        self._trie: dict = {}
+        for domain in ALLOWED_DOMAINS:
+            node = self._trie
+            for label in reversed(domain.lower().strip(".").split(".")):
+                node = node.setdefault(label, {})
+            node[self._END] = True
+        parts = []
+        for group, patterns in (("out", SCOPE_EXCLUDE), ("in", SCOPE_INCLUDE)):
+            if patterns:
+                alternatives = "|".join(f"(?:{rx})" for rx in patterns)
+                parts.append(f"(?P<{group}>.*?(?:{alternatives}))")
+        self._paths = re.compile("|".join(parts), re.DOTALL) if parts else None
+        self._include = bool(SCOPE_INCLUDE)
+
+    def host_allowed(self, netloc: str) -> bool:
+        node = self._trie
+        for label in reversed(netloc.lower().split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self._END in node:
+                return True
+        return False
+
+    def path_allowed(self, path: str) -> bool:
+        if self._paths is None:
+            return True
+        m = self._paths.match(path)
+        if m is None:
+            return not self._include
+        return m.lastgroup == "in"
+
+    def allows(self, url: str) -> bool:
+        """True if the page at *url* is to be crawled."""
+        p = urlsplit(url)
+        if not self.host_allowed(p.netloc):
+            return False
+        return self.path_allowed(p.path + ("?" + p.query if p.query else ""))
+
+
+def _url_variant(url: str) -> str:
+    """A URL minus fragment and trailing slash: one fetch per variant."""
     p = urlparse(url)
     path = p.path.rstrip("/") or "/"
     return urlunparse((p.scheme, p.netloc, path, p.params, p.query, ""))
 
 
+def _glob_matcher(patterns):
+    """fullmatch() of any of the glob *patterns*, ignoring case, or None."""
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns),
+                      re.IGNORECASE).fullmatch
+
+
+_PERCENT_RE = re.compile(r"%[0-9A-Fa-f]{2}")
+_UNRESERVED = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+                        "0123456789-._~")
+_PATH_PARAM_RE = re.compile(r";([^/;=]*)=[^/;]*")
+
+
+def _percent(m) -> str:
+    char = chr(int(m.group(0)[1:], 16))
+    return char if char in _UNRESERVED else m.group(0).upper()
+
+
+class UrlCanonicaliser:
+    """
+    One spelling for all variants of a URL, so each page or file is
+    fetched and saved once.
+
+    The fragment and a trailing slash always go; CANONICAL_RULES adds:
+
+      host              lower-case host, no trailing dot
+      default_port      drop :80 on http and :443 on https
+      percent_encoding  upper-case escapes, unescape letters and digits
+      index_pages       /dir/index.html -> /dir (INDEX_PAGES)
+      tracking_params   drop TRACKING_PARAMS (utm_* …) from the query
+      session_ids       drop SESSION_PARAMS from the query and ;jsessionid=
+      sort_query        order query parameters by name
+      scheme            http and https share a key (see key())
+
+    SITE_URL_RULES adds, for a domain and its subdomains, regex
+    "rewrite" pairs applied to the whole URL first, "drop_params" globs
+    and a "keep_params" list that drops every other parameter.
+    url() is the form that is fetched and stored; key() is what
+    enqueued, saved and the metadata are indexed by.
+    """
+
+    def __init__(self):
+        rules = set(CANONICAL_RULES)
+        self._rules = rules
+        self._drop = _glob_matcher(
+            (TRACKING_PARAMS if "tracking_params" in rules else [])
+            + (SESSION_PARAMS if "session_ids" in rules else []))
+        self._session = _glob_matcher(SESSION_PARAMS if "session_ids" in rules else [])
+        self._index = ({p.lower() for p in INDEX_PAGES}
+                       if "index_pages" in rules else set())
+        self._sites = [
+            (domain.lower(),
+             [(re.compile(rx), repl) for rx, repl in site.get("rewrite", ())],
+             _glob_matcher(site.get("drop_params")),
+             _glob_matcher(site.get("keep_params")))
+            for domain, site in SITE_URL_RULES.items()
+        ]
+
+    def url(self, url: str) -> str:
+        drop = self._drop
+        drops, keep = [drop] if drop else [], None
+        if self._sites:
+            host = (urlsplit(url).hostname or "").rstrip(".")
+            for domain, rewrites, site_drop, site_keep in self._sites:
+                if host == domain or host.endswith("." + domain):
+                    for rx, repl in rewrites:
+                        url = rx.sub(repl, url)
+                    if site_drop:
+                        drops.append(site_drop)
+                    keep = site_keep or keep
+        p = urlsplit(url)
+        scheme, netloc, path, query = p.scheme.lower(), p.netloc, p.path, p.query
+        rules = self._rules
+        if "host" in rules or "default_port" in rules:
+            userinfo, at, hostport = netloc.rpartition("@")
+            if "host" in rules:
+                hostport = re.sub(r"\.(?=(:\d*)?$)", "", hostport.lower())
+            if "default_port" in rules:
+                default = {"http": ":80", "https": ":443"}.get(scheme)
+                if hostport.endswith(":") or (default and hostport.endswith(default)):
+                    hostport = hostport[:hostport.rindex(":")]
+            netloc = userinfo + at + hostport
+        if "percent_encoding" in rules:
+            path = _PERCENT_RE.sub(_percent, path)
+            query = _PERCENT_RE.sub(_percent, query)
+        if self._session and ";" in path:
+            path = _PATH_PARAM_RE.sub(
+                lambda m: "" if self._session(m.group(1)) else m.group(0), path)
+        if self._index:
+            head, _, last = path.rpartition("/")
+            if last.lower() in self._index:
+                path = head + "/"
+        path = path.rstrip("/") or "/"
+        if query:
+            params = [kv for kv in query.split("&") if kv]
+            if drops or keep:
+                def wanted(kv):
+                    name = unquote(kv.split("=", 1)[0])
+                    if keep is not None:
+                        return bool(keep(name))
+                    return not any(d(name) for d in drops)
+                params = [kv for kv in params if wanted(kv)]
+            if "sort_query" in rules:
+                params.sort(key=lambda kv: kv.split("=", 1)[0])
+            query = "&".join(params)
+        return urlunsplit((scheme, netloc, path, query, ""))
+
+    def key(self, url: str) -> str:
+        url = self.url(url)
+        if "scheme" in self._rules and url.startswith("http://"):
+            url = "https://" + url[7:]
+        return url
+
+
+_canonicaliser: UrlCanonicaliser | None = None
+
+
+def _canon() -> UrlCanonicaliser:
+    global _canonicaliser
+    if _canonicaliser is None:
+        _canonicaliser = UrlCanonicaliser()
+    return _canonicaliser
+
+
+def canonical_url(url: str) -> str:
+    """The form of *url* that is fetched and saved (UrlCanonicaliser.url)."""
+    return _canon().url(url)
+
+
+def _normalise_url(url: str) -> str:
+    """De-duplication key of *url* (UrlCanonicaliser.key)."""
+    return _canon().key(url)
+
+
 def _relative_link(from_path: str, to_path: str) -> str:
     """Return a relative path from *from_path* to *to_path*."""
     return os.path.relpath(to_path, os.path.dirname(from_path)).replace("\\", "/")
 
 
-# ---------------------------------------------------------------------------
-# Downloader class
-# ---------------------------------------------------------------------------
+# <a href> values are written as _LINK_OPEN + href + _LINK_CLOSE while the
+# crawl runs (their targets may not be saved yet) and resolved at the end
+# by a byte-level splice; U+E000/U+E001 are private-use code points.
+_LINK_OPEN, _LINK_CLOSE = "\ue000", "\ue001"
+_LINK_PLACEHOLDER_RE = re.compile(
+    re.escape(_LINK_OPEN.encode()) + rb"(.*?)" + re.escape(_LINK_CLOSE.encode()),
+    re.DOTALL,
+)
 
-class SiteMirror:
-    def __init__(self):
-        self.session = requests.Session()
 
-        # Automatic retry with exponential backoff on 429 / 500 / 502 / 503
-        retry_strategy = Retry(
-            total=5,                        # up to 5 retries per request
-            backoff_factor=1,               # waits 1s, 2s, 4s, 8s, 16s …
-            status_forcelist=[429, 500, 502, 503, 504],
-            respect_retry_after_header=True, # honour Retry-After from server
-            allowed_methods=["GET", "HEAD"],
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("https://", adapter)
-        self.session.mount("http://", adapter)
+def _escape_attr(value: str) -> str:
+    """Escape an attribute value the way BeautifulSoup serialises it."""
+    return (value.replace("&", "&amp;").replace("<", "&lt;")
+                 .replace(">", "&gt;").replace('"', "&quot;"))
 
-        # url  -> local file path   (for everything we saved)
-        self.saved: dict[str, str] = {}
-        # BFS queue: (url, depth)
-        self.queue: deque[tuple[str, int]] = deque()
-        # Set of normalised URLs already enqueued (pages only)
-        self.enqueued: set[str] = set()
 
-    # ----- throttled request ------------------------------------------------
+def _parse_retry_after(value: str | None) -> float | None:
+    """Turn a Retry-After header (seconds or HTTP date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
 
-    def _get(self, url: str, **kwargs) -> requests.Response:
-        """GET with a polite random delay and rotating User-Agent."""
-        time.sleep(random.uniform(*REQUEST_DELAY))
-        self.session.headers["User-Agent"] = random.choice(USER_AGENTS)
-        return self.session.get(url, timeout=REQUEST_TIMEOUT, **kwargs)
 
-    # ----- asset downloading ------------------------------------------------
+def _parse_lastmod(value: str | None) -> float | None:
+    """A sitemap <lastmod> (W3C datetime) as a Unix timestamp, or None."""
+    if not value:
+        return None
+    try:
+        when = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
 
-    def _download_binary(self, url: str) -> str | None:
-        """Download a binary asset and return its local path, or None."""
-        norm = _normalise_url(url)
-        if norm in self.saved:
-            return self.saved[norm]
+
+def _iter_sitemap(fileobj):
+    """
+    Yield (kind, loc, lastmod) from a sitemap or sitemap index, where kind
+    is "url" or "sitemap". The XML is parsed incrementally and every entry
+    is discarded once yielded, so memory does not grow with the file.
+    """
+    loc = lastmod = None
+    for _, elem in ET.iterparse(fileobj, events=("end",)):
+        tag = elem.tag.rpartition("}")[2]
+        if tag == "loc":
+            loc = (elem.text or "").strip()
+        elif tag == "lastmod":
+            lastmod = elem.text
+        elif tag in ("url", "sitemap"):
+            if loc:
+                yield tag, loc, lastmod
+            loc = lastmod = None
+            elem.clear()
+
+
+class FileTooLarge(Exception):
+    """A download exceeded MAX_FILE_SIZE."""
+
+
+class DeadlineExceeded(requests.Timeout):
+    """A request ran past REQUEST_DEADLINE."""
+
+
+class HostUnavailable(requests.ConnectionError):
+    """A host's circuit breaker is open (see HostScheduler._trip)."""
+
+
+def _check_length(resp: requests.Response):
+    """Raise FileTooLarge if the Content-Length is over MAX_FILE_SIZE."""
+    length = resp.headers.get("Content-Length", "")
+    if MAX_FILE_SIZE is not None and length.isdigit() and int(length) > MAX_FILE_SIZE:
+        raise FileTooLarge(f"{length} bytes > MAX_FILE_SIZE")
+
+
+def _read_body(resp: requests.Response):
+    """
+    Load a streamed body into resp.content, raising FileTooLarge as soon
+    as it is known to be over MAX_FILE_SIZE (from Content-Length before
+    reading anything, else once that many bytes have arrived).
+    """
+    if resp.status_code != 304:     # its Content-Length may be the stored file's
+        _check_length(resp)
+    if getattr(resp, "_content_consumed", True):
+        return
+    chunks = []
+    size = 0
+    for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if MAX_FILE_SIZE is not None and size > MAX_FILE_SIZE:
+            raise FileTooLarge(f"over {MAX_FILE_SIZE} bytes")
+        chunks.append(chunk)
+    resp._content = b"".join(chunks)
+
+
+def _drain(resp: requests.Response):
+    """
+    Read the rest of a streamed body that is empty (304, 204) or known to
+    be small, so closing the response hands its connection back to the
+    pool: urllib3 drops a connection whose body was left unread.
+    """
+    if getattr(resp, "_content_consumed", True):
+        return
+    length = resp.headers.get("Content-Length", "")
+    if resp.status_code in (204, 304) or \
+            (length.isdigit() and int(length) <= DOWNLOAD_CHUNK_SIZE):
         try:
-            resp = self._get(url)
-            resp.raise_for_status()
-        except Exception as exc:
-            print(f"  [!] asset error {url}: {exc}")
-            return None
-        local = url_to_local_path(url)
+            resp.content
+        except (requests.RequestException, OSError):
+            pass                # the connection is dropped after all
+
+
+def _file_mode() -> int:
+    """Mode open() would give a new file (mkstemp's are owner-only)."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Read once at import: os.umask() cannot be queried without setting it
+_FILE_MODE = _file_mode()
+
+
+def _replace_file(local: str, data: bytes):
+    """
+    Write *data* to *local* via a temp file renamed over it. A blob that
+    an earlier run linked at *local* is then unlinked from it, never
+    written through (see BlobStore).
+    """
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    tmp = f"{local}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, local)
+
+
+def _stream_to_file(resp: requests.Response, local: str,
+                    store: "BlobStore | MirrorArchive | None" = None,
+                    spent=None) -> tuple[int, str]:
+    """
+    Write a streamed response body to *local*; return (size, sha256).
+
+    The body goes to a temp file inside OUTPUT_DIR in DOWNLOAD_CHUNK_SIZE
+    pieces and is renamed into place once complete, so memory use does not
+    depend on the file size and a half-written file never appears under
+    its final name. Bodies over MAX_FILE_SIZE raise FileTooLarge.
+
+    With a *store* (blob store or packed archive) the finished body is
+    handed to store.add() instead of being renamed to *local*; bodies up
+    to BLOB_MEMORY_LIMIT are then kept in memory until their hash is
+    known, so a duplicate blob is never written at all.
+
+    The time spent writing is reported once as spent("write", seconds),
+    so a caller timing the whole download can tell it from network time.
+    """
+    _check_length(resp)
+
+    fh = tmp = None
+    if store is None:
         os.makedirs(os.path.dirname(local), exist_ok=True)
-        with open(local, "wb") as fh:
-            fh.write(resp.content)
-        self.saved[norm] = local
-        print(f"  [asset] {url}  ->  {local}")
-        return local
+        fd, tmp = tempfile.mkstemp(dir=OUTPUT_DIR, prefix=".part-")
+        os.chmod(tmp, _FILE_MODE)
+        fh = os.fdopen(fd, "wb")
+    buffered: list[bytes] = []
+    size = 0
+    digest = hashlib.sha256()
+    writing = 0.0
+    try:
+        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if MAX_FILE_SIZE is not None and size > MAX_FILE_SIZE:
+                raise FileTooLarge(f"over {MAX_FILE_SIZE} bytes")
+            digest.update(chunk)
+            if fh is None:
+                if size <= BLOB_MEMORY_LIMIT:
+                    buffered.append(chunk)
+                    continue
+                # Too big to hold: spill what we have and keep streaming
+                # (requisites can arrive before anything else is written)
+                os.makedirs(OUTPUT_DIR, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=OUTPUT_DIR, prefix=".part-")
+                os.chmod(tmp, _FILE_MODE)
+                fh = os.fdopen(fd, "wb")
+                fh.writelines(buffered)
+                buffered.clear()
+            start = time.perf_counter()
+            fh.write(chunk)
+            writing += time.perf_counter() - start
+        sha256 = digest.hexdigest()
+        start = time.perf_counter()
+        if fh is not None:
+            fh.close()
+        if store is None:
+            os.replace(tmp, local)
+        else:
+            store.add(local, sha256, size, tmp=tmp, data=b"".join(buffered))
+        writing += time.perf_counter() - start
+    except BaseException:
+        if fh is not None:
+            fh.close()
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        raise
+    finally:
+        if spent is not None:
+            spent("write", writing)
+    return size, sha256
 
-    # ----- CSS url() rewriting ---------------------------------------------
 
-    _CSS_URL_RE = re.compile(
-        r"""url\(\s*(['"]?)(.+?)\1\s*\)""", re.IGNORECASE
-    )
+class BlobStore:
+    """
+    Content-addressed storage for downloaded files.
 
-    def _download_and_rewrite_css(self, css_url: str) -> str | None:
-        """Download a CSS file, rewrite url() references, save locally."""
-        norm = _normalise_url(css_url)
-        if norm in self.saved:
-            return self.saved[norm]
-        try:
-            resp = self._get(css_url)
-            resp.raise_for_status()
-        except Exception as exc:
-            print(f"  [!] CSS error {css_url}: {exc}")
-            return None
+    Every distinct body is stored once as <root>/<aa>/<sha256>, and the
+    per-URL path under OUTPUT_DIR becomes a hard link (or, with
+    BLOB_LINK = "symlink", a relative symlink) to it. Cache-busted
+    ``?v=`` variants, CDN mirrors and repeated sprites then cost one file
+    on disk. Blobs are never modified in place: new content always gets a
+    new blob, so updating one URL cannot change another.
+    """
 
-        css_local = url_to_local_path(css_url)
-        os.makedirs(os.path.dirname(css_local), exist_ok=True)
-
-        text = resp.text
-
-        def _replace_css_url(m):
-            quote = m.group(1)
-            ref = m.group(2).strip()
-            if ref.startswith("data:"):
-                return m.group(0)
-            abs_url = urljoin(css_url, ref)
-            asset_path = self._download_binary(abs_url)
-            if asset_path:
-                rel = _relative_link(css_local, asset_path)
-                return f"url({quote}{rel}{quote})"
-            return m.group(0)
+    def __init__(self, root: str, link_mode: str):
+        self.root = root
+        self.link_mode = link_mode
+        self._lock = threading.Lock()
+        self.files = 0          # files stored through the blob store
+        self.duplicates = 0     # ... whose body was already a blob
+        self.bytes_saved = 0    # bytes not written thanks to those
 
-        text = self._CSS_URL_RE.sub(_replace_css_url, text)
-        with open(css_local, "w", encoding="utf-8") as fh:
-            fh.write(text)
-        self.saved[norm] = css_local
-        print(f"  [css]   {css_url}  ->  {css_local}")
-        return css_local
+    def add(self, local: str, sha256: str, size: int,
+            tmp: str | None = None, data: bytes = b""):
+        """Store a body (temp file *tmp*, else *data*) and link *local* to it."""
+        blob = os.path.join(self.root, sha256[:2], sha256)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with self._lock:
+            self.files += 1
+            if os.path.exists(blob):
+                self.duplicates += 1
+                self.bytes_saved += size
+                if tmp is not None:
+                    os.unlink(tmp)
+            elif tmp is not None:
+                os.replace(tmp, blob)
+            else:
+                with open(blob + ".tmp", "wb") as fh:
+                    fh.write(data)
+                os.replace(blob + ".tmp", blob)
+        self._link(blob, local)
 
-    # ----- single page processing -------------------------------------------
+    def _link(self, blob: str, local: str):
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        link_tmp = f"{local}.{threading.get_ident()}.link"
+        if self.link_mode == "symlink":
+            os.symlink(os.path.relpath(blob, os.path.dirname(local)), link_tmp)
+        else:
+            try:
+                os.link(blob, link_tmp)
+            except OSError:         # no hard links here (FAT, cross-device …)
+                shutil.copyfile(blob, link_tmp)
+        os.replace(link_tmp, local)
 
-    # Tags & attributes that reference external resources
-    _ASSET_ATTRS = [
-        ("img",    "src"),
-        ("img",    "data-src"),      # lazy-loaded images
-        ("script", "src"),
-        ("link",   "href"),          # CSS, icons, preload…
-        ("source", "src"),
-        ("source", "srcset"),
-        ("video",  "src"),
-        ("video",  "poster"),
-        ("audio",  "src"),
-    ]
+    def summary(self) -> str:
+        return (f"{self.files} files stored as {self.files - self.duplicates} "
+                f"new blobs, {self.duplicates} duplicates, "
+                f"{self.bytes_saved} bytes not written")
 
-    def _process_page(self, url: str, depth: int):
-        """Download an HTML page, its requisites, and enqueue child links."""
-        norm = _normalise_url(url)
-        if norm in self.saved:
-            return
-        try:
-            resp = self._get(url)
-            resp.raise_for_status()
-        except Exception as exc:
-            print(f"[!] page error {url}: {exc}")
-            return
 
-        content_type = resp.headers.get("Content-Type", "")
-        if "text/html" not in content_type:
-            # Not an HTML page — save as binary asset instead
-            local = url_to_local_path(url)
-            os.makedirs(os.path.dirname(local), exist_ok=True)
-            with open(local, "wb") as fh:
-                fh.write(resp.content)
-            self.saved[norm] = local
+class MirrorArchive:
+    """
+    The mirror packed into one zip file (ARCHIVE_FILE) instead of a tree.
+
+    Entries are named by their path under OUTPUT_DIR (url_to_local_path()
+    minus the OUTPUT_DIR prefix), so the relative links written into
+    pages and stylesheets resolve between entries exactly as between
+    files. Members are stored uncompressed, which lets serve_archive()
+    send them with sendfile() straight from the archive. add() has the
+    BlobStore interface, so _stream_to_file() can write into either.
+
+    The archive is written as <ARCHIVE_FILE>.part and renamed by close();
+    its zip comment names the start page.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._zip = zipfile.ZipFile(path + ".part", "w", zipfile.ZIP_STORED)
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+
+    @staticmethod
+    def name(local: str) -> str:
+        return os.path.relpath(local, OUTPUT_DIR).replace(os.sep, "/")
+
+    def add(self, local: str, sha256: str | None, size: int,
+            tmp: str | None = None, data: bytes = b""):
+        """Store a body (temp file *tmp*, else *data*) as entry *local*."""
+        with self._lock:
+            if tmp is not None:
+                self._zip.write(tmp, self.name(local))
+            else:
+                self._zip.writestr(self.name(local), data)
+            self.files += 1
+            self.bytes += size
+        if tmp is not None:
+            os.unlink(tmp)
+
+    def close(self, start_local: str | None):
+        with self._lock:
+            if start_local:
+                self._zip.comment = self.name(start_local).encode("utf-8")
+            self._zip.close()
+        os.replace(self.path + ".part", self.path)
+
+
+def serve_archive(path: str, port: int = 8000, bind: str = "127.0.0.1"):
+    """
+    Serve a MirrorArchive over HTTP; "/" redirects to the start page.
+
+    The member offsets are read once from the zip's local headers; each
+    response body is then sent with socket.sendfile(), which uses
+    os.sendfile() (no copy through user space) where the OS has it.
+    """
+    index: dict[str, tuple[int, int]] = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as fh:
+        start = zf.comment.decode("utf-8")
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                continue
+            fh.seek(info.header_offset)
+            name_len, extra_len = struct.unpack("<26xHH", fh.read(30))
+            index[info.filename] = (
+                info.header_offset + 30 + name_len + extra_len, info.file_size
+            )
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self._send(body=True)
+
+        def do_HEAD(self):
+            self._send(body=False)
+
+        def _send(self, body: bool):
+            name = unquote(urlparse(self.path).path).lstrip("/")
+            if not name and start:
+                self.send_response(302)
+                self.send_header("Location", "/" + quote(start))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            entry = index.get(name) or index.get(name.rstrip("/") + "/index.html")
+            if entry is None:
+                self.send_error(404)
+                return
+            offset, size = entry
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             mimetypes.guess_type(name)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            if body and size:
+                # Own file object per request: sendfile() moves its position
+                with open(path, "rb") as archive:
+                    self.connection.sendfile(archive, offset, size)
+
+    server = ThreadingHTTPServer((bind, port), Handler)
+    server.daemon_threads = True
+    print(f"Serving {path} ({len(index)} files) on http://{bind}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# HTML parser backends
+# ---------------------------------------------------------------------------
+# Each document exposes the few operations the mirror needs: find elements
+# carrying an attribute, read / write attributes and inline <style> text,
+# and serialise. Element handles are opaque to the caller.
+
+class _SoupDocument:
+    """BeautifulSoup tree, built by "html.parser" (pure Python) or "lxml"."""
+
+    def __init__(self, markup: str, features: str):
+        self._soup = BeautifulSoup(markup, features)
+
+    def find(self, tag: str, attr: str) -> list:
+        """Elements named *tag* that carry *attr* (possibly empty)."""
+        return self._soup.find_all(tag, attrs={attr: True})
+
+    def get(self, el, attr: str) -> str | None:
+        value = el.get(attr)
+        if isinstance(value, list):     # multi-valued attributes such as rel
+            value = " ".join(value)
+        return value
+
+    def set(self, el, attr: str, value: str):
+        el[attr] = value
+
+    def styles(self) -> list:
+        return [tag for tag in self._soup.find_all("style") if tag.string]
+
+    def style_text(self, el) -> str:
+        return el.string
+
+    def set_style_text(self, el, text: str):
+        el.string = text
+
+    def serialise(self) -> str:
+        return str(self._soup)
+
+
+class _LexborDocument:
+    """selectolax / lexbor tree: parsing and serialising happen in C."""
+
+    def __init__(self, markup: str):
+        self._tree = LexborHTMLParser(markup)
+
+    def find(self, tag: str, attr: str) -> list:
+        return [n for n in self._tree.css(tag) if attr in n.attributes]
+
+    def get(self, el, attr: str) -> str | None:
+        value = el.attributes.get(attr)
+        return "" if value is None and attr in el.attributes else value
+
+    def set(self, el, attr: str, value: str):
+        el.attrs[attr] = value
+
+    def styles(self) -> list:
+        return [n for n in self._tree.css("style") if n.text()]
+
+    def style_text(self, el) -> str:
+        return el.text()
+
+    def set_style_text(self, el, text: str):
+        el.inner_html = text            # <style> content is raw text
+
+    def serialise(self) -> str:
+        return self._tree.html
+
+
+# Elements whose content is raw text: tags inside them are not tags
+_RAW_TEXT_TAGS = ("script", "style", "textarea", "title", "xmp", "iframe",
+                  "noembed", "noframes")
+_RAW_TEXT_END_RE = {
+    tag: re.compile(rf"</{tag}[\s/>]", re.IGNORECASE) for tag in _RAW_TEXT_TAGS
+}
+_MARKUP_RE = re.compile(r"<(?:(!--)|([!?/])|([a-zA-Z][^\s/>]*))")
+_ATTR_RE = re.compile(
+    r"""[\s/]*(?:([^\s"'>/=][^\s"'>/=]*)(\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?)?"""
+)
+
+
+def iter_html_events(markup: str, tags=None):
+    """
+    Scan *markup* once, without building a tree, and yield
+    ``(tag, attr, value, span)`` events.
+
+    For every start tag named in *tags* (all tags if None) an event with
+    ``attr=None`` marks the start of a new element, followed by one event
+    per attribute: *value* is entity-decoded ("" for a bare attribute) and
+    *span* covers everything after the attribute name up to the end of its
+    value, so writing ``="new"`` over it rewrites the attribute. The body of
+    a <style> element is reported as attribute "#text" with its raw text.
+    Comments, doctypes, end tags and raw-text content (scripts …) are
+    skipped.
+    """
+    pos, end = 0, len(markup)
+    while True:
+        m = _MARKUP_RE.search(markup, pos)
+        if m is None:
             return
+        if m.group(1):                          # <!-- comment -->
+            close = markup.find("-->", m.end())
+            pos = end if close < 0 else close + 3
+            continue
+        if m.group(2):                          # </end>, <!DOCTYPE>, <?pi?>
+            close = markup.find(">", m.end())
+            pos = end if close < 0 else close + 1
+            continue
 
-        soup = BeautifulSoup(resp.text, "html.parser")
-        page_local = _ensure_html_extension(url_to_local_path(url))
+        tag = m.group(3).lower()
+        wanted = tags is None or tag in tags
+        if wanted:
+            yield tag, None, None, (m.start(), m.start())
+        pos = m.end()
+        seen = set()
+        while True:
+            a = _ATTR_RE.match(markup, pos)
+            pos = a.end()
+            if not a.group(1):
+                break
+            name = a.group(1).lower()
+            if not wanted or name in seen:      # first duplicate wins
+                continue
+            seen.add(name)
+            raw = a.group(3)
+            if raw is None:
+                value = ""
+            elif raw[:1] in "\"'":
+                value = unescape(raw[1:-1])
+            else:
+                value = unescape(raw)
+            yield tag, name, value, (a.end(1), a.end())
+        if markup.startswith(">", pos):
+            pos += 1
 
-        # --- 1. Download page requisites (assets) --------------------------
-        for tag_name, attr in self._ASSET_ATTRS:
-            for tag in soup.find_all(tag_name):
-                raw = tag.get(attr)
-                if not raw:
-                    continue
+        if tag in _RAW_TEXT_END_RE:
+            close = _RAW_TEXT_END_RE[tag].search(markup, pos)
+            body_end = end if close is None else close.start()
+            if tag == "style" and wanted:
+                yield tag, "#text", markup[pos:body_end], (pos, body_end)
+            pos = body_end
 
-                # Handle srcset (comma-separated list of "url size")
-                if attr == "srcset":
-                    new_parts = []
-                    for part in raw.split(","):
-                        tokens = part.strip().split()
-                        if not tokens:
-                            continue
-                        asset_url = urljoin(url, tokens[0])
-                        local = self._download_binary(asset_url)
-                        if local:
-                            tokens[0] = _relative_link(page_local, local)
-                        new_parts.append(" ".join(tokens))
-                    tag[attr] = ", ".join(new_parts)
-                    continue
 
-                asset_url = urljoin(url, raw)
+class _StreamDocument:
+    """
+    No DOM at all: iter_html_events() records the spans of the attributes
+    and <style> bodies the mirror needs, and serialise() splices the edits
+    into the original text. Memory is proportional to the document, and
+    everything that is not rewritten comes out byte for byte as it came in.
+    """
 
-                # CSS gets special treatment so we can rewrite url() inside it
-                is_css = (
-                    tag_name == "link"
-                    and (tag.get("rel") or [""])[0] == "stylesheet"
-                )
-                if is_css:
-                    local = self._download_and_rewrite_css(asset_url)
-                else:
-                    local = self._download_binary(asset_url)
-
-                if local:
-                    tag[attr] = _relative_link(page_local, local)
-
-        # Inline <style> blocks — rewrite url() references
-        for style_tag in soup.find_all("style"):
-            if style_tag.string:
-                def _replace_inline(m, _base=url, _page=page_local):
-                    quote = m.group(1)
-                    ref = m.group(2).strip()
-                    if ref.startswith("data:"):
-                        return m.group(0)
-                    abs_url = urljoin(_base, ref)
-                    asset_path = self._download_binary(abs_url)
-                    if asset_path:
-                        rel = _relative_link(_page, asset_path)
-                        return f"url({quote}{rel}{quote})"
-                    return m.group(0)
-                style_tag.string = self._CSS_URL_RE.sub(
-                    _replace_inline, style_tag.string
-                )
+    def __init__(self, markup: str):
+        self._markup = markup
+        self._elements: dict[str, list[dict]] = {}
+        self._edits: dict[int, tuple[int, str]] = {}    # start -> (end, text)
+        element = None
+        for tag, attr, value, span in iter_html_events(markup, _STREAM_TAGS):
+            if attr is None:
+                element = {}
+                self._elements.setdefault(tag, []).append(element)
+            else:
+                element[attr] = (value, span)
 
-        # --- 2. Discover and enqueue child links ---------------------------
-        if depth < MAX_DEPTH:
-            for a_tag in soup.find_all("a", href=True):
-                href = a_tag["href"]
-                child_url = _normalise_url(urljoin(url, href))
-                if _is_same_domain(child_url) and child_url not in self.enqueued:
-                    self.enqueued.add(child_url)
-                    self.queue.append((child_url, depth + 1))
+    def find(self, tag: str, attr: str) -> list:
+        return [el for el in self._elements.get(tag, ()) if attr in el]
 
-        # --- 3. Rewrite <a href> to local paths (for already-saved pages) --
-        #     We do a second pass at the end (see _rewrite_links) so that
-        #     links to pages we haven't downloaded yet can also be converted.
+    def get(self, el, attr: str) -> str | None:
+        found = el.get(attr)
+        return found[0] if found else None
 
-        # --- 4. Save the page -----------------------------------------------
-        os.makedirs(os.path.dirname(page_local), exist_ok=True)
-        with open(page_local, "w", encoding="utf-8") as fh:
-            fh.write(str(soup))
-        self.saved[norm] = page_local
-        print(f"[page]  {url}  ->  {page_local}  (depth={depth})")
+    def set(self, el, attr: str, value: str):
+        el[attr] = (value, el[attr][1])
+        start, end = el[attr][1]
+        self._edits[start] = (end, f'="{_escape_attr(value)}"')
 
-    # ----- second pass: convert <a> links -----------------------------------
+    def styles(self) -> list:
+        return [el for el in self._elements.get("style", ())
+                if el.get("#text", ("",))[0]]
 
-    def _rewrite_links(self):
-        """
-        After all pages are downloaded, open each saved HTML file and
-        rewrite every <a href="…"> that points at another saved page
-        so it uses a relative local path.
-        """
-        print("\n— Rewriting links …")
-        for norm_url, local_path in list(self.saved.items()):
-            if not local_path.endswith(".html"):
+    def style_text(self, el) -> str:
+        return el["#text"][0]
+
+    def set_style_text(self, el, text: str):
+        el["#text"] = (text, el["#text"][1])
+        start, end = el["#text"][1]
+        self._edits[start] = (end, text)
+
+    def serialise(self) -> str:
+        parts, pos = [], 0
+        for start in sorted(self._edits):
+            end, text = self._edits[start]
+            parts.append(self._markup[pos:start])
+            parts.append(text)
+            pos = end
+        parts.append(self._markup[pos:])
+        return "".join(parts)
+
+
+def _parse_html(markup: str, backend: str):
+    """
+    Parse *markup* with *backend* (one of the PARSER_BACKEND values).
+
+    "auto" picks the fastest backend installed (lexbor, then lxml). If the
+    chosen backend is missing or fails on a document, the pure-Python
+    html.parser backend is used instead, so every page still gets parsed.
+    "stream" never builds a tree (see _StreamDocument).
+    """
+    if backend == "auto":
+        backend = ("lexbor" if LexborHTMLParser is not None
+                   else "lxml" if _HAVE_LXML else "html.parser")
+    try:
+        if backend == "stream":
+            return _StreamDocument(markup)
+        if backend == "lexbor" and LexborHTMLParser is not None:
+            return _LexborDocument(markup)
+        if backend == "lxml" and _HAVE_LXML:
+            return _SoupDocument(markup, "lxml")
+    except Exception as exc:
+        print(f"  [!] {backend} parser failed ({exc}); using html.parser")
+    return _SoupDocument(markup, "html.parser")
+
+
+# ---------------------------------------------------------------------------
+# Page analysis (may run in a worker process)
+# ---------------------------------------------------------------------------
+
+# Tags & attributes that reference external resources
+_ASSET_ATTRS = [
+    ("img",    "src"),
+    ("img",    "data-src"),      # lazy-loaded images
+    ("script", "src"),
+    ("link",   "href"),          # CSS, icons, preload…
+    ("source", "src"),
+    ("source", "srcset"),
+    ("video",  "src"),
+    ("video",  "poster"),
+    ("audio",  "src"),
+]
+
+# Elements the "stream" backend records (see iter_html_events)
+_STREAM_TAGS = frozenset({tag for tag, _ in _ASSET_ATTRS} | {"a", "style"})
+
+# url(...) — possibly after @import — or @import "..." without url()
+_CSS_REF_RE = re.compile(
+    r"""(?P<imp>@import\s+)?url\(\s*(?P<q>['"]?)(?P<url>.+?)(?P=q)\s*\)"""
+    r"""|@import\s+(?P<sq>['"])(?P<str>.+?)(?P=sq)""",
+    re.IGNORECASE,
+)
+
+# Requisite references are serialised as _SLOT_OPEN + index + _SLOT_CLOSE
+# and filled in by _fill_slots() once the asset downloads have finished.
+_SLOT_OPEN, _SLOT_CLOSE = "\ue002", "\ue003"
+_SLOT_RE = re.compile(_SLOT_OPEN + r"(\d+)" + _SLOT_CLOSE)
+
+
+def _analyse_page(url: str, markup: str, backend: str):
+    """
+    Parse a page once and return ``(template, slots, links)``.
+
+    *template* is the serialised page with every requisite reference
+    replaced by a slot placeholder and every <a href> wrapped in link
+    placeholders. *slots* lists, per placeholder, ``(asset_url, kind,
+    prefix, suffix, fallback, in_attr)``: the text to emit is prefix +
+    local path + suffix once the asset is saved, else *fallback*. *links*
+    holds the normalised target of every <a href>.
+
+    This runs in a worker process when PARSE_PROCESSES > 0, so it must
+    depend only on its arguments and return picklable data.
+    """
+    doc = _parse_html(markup, backend)
+    slots: list[tuple] = []
+
+    def _slot(asset_url, kind, prefix, suffix, fallback, in_attr) -> str:
+        slots.append((asset_url, kind, prefix, suffix, fallback, in_attr))
+        return f"{_SLOT_OPEN}{len(slots) - 1}{_SLOT_CLOSE}"
+
+    for tag_name, attr in _ASSET_ATTRS:
+        for tag in doc.find(tag_name, attr):
+            raw = doc.get(tag, attr)
+            if not raw:
                 continue
-            with open(local_path, "r", encoding="utf-8") as fh:
-                soup = BeautifulSoup(fh.read(), "html.parser")
 
-            changed = False
-            for a_tag in soup.find_all("a", href=True):
-                href = a_tag["href"]
-                abs_url = _normalise_url(urljoin(norm_url, href))
-                target_local = self.saved.get(abs_url)
-                if target_local:
-                    rel = _relative_link(local_path, target_local)
-                    if a_tag["href"] != rel:
-                        a_tag["href"] = rel
-                        changed = True
+            # Handle srcset (comma-separated list of "url size")
+            if attr == "srcset":
+                new_parts = []
+                for part in raw.split(","):
+                    tokens = part.strip().split()
+                    if not tokens:
+                        continue
+                    tokens[0] = _slot(urljoin(url, tokens[0]), "binary", "", "",
+                                      _escape_attr(tokens[0]), True)
+                    new_parts.append(" ".join(tokens))
+                doc.set(tag, attr, ", ".join(new_parts))
+                continue
 
-            if changed:
-                with open(local_path, "w", encoding="utf-8") as fh:
-                    fh.write(str(soup))
-                print(f"  [relink] {local_path}")
+            # CSS gets special treatment so we can rewrite url() inside it
+            is_css = (
+                tag_name == "link"
+                and (doc.get(tag, "rel") or "").split()[:1] == ["stylesheet"]
+            )
+            doc.set(tag, attr, _slot(urljoin(url, raw),
+                                     "css" if is_css else "binary",
+                                     "", "", _escape_attr(raw), True))
 
-    # ----- public entry point -----------------------------------------------
+    # Inline <style> blocks — url() and @import references
+    for style_tag in doc.styles():
+        doc.set_style_text(
+            style_tag, _css_template(doc.style_text(style_tag), url, _slot)
+        )
 
-    def run(self, start_url: str):
-        norm = _normalise_url(start_url)
-        self.enqueued.add(norm)
-        self.queue.append((start_url, 0))
+    # <a href>: targets may not be downloaded yet, so every href is wrapped
+    # in link placeholders that _rewrite_links() resolves at the end
+    links = []
+    for a_tag in doc.find("a", "href"):
+        href = doc.get(a_tag, "href")
+        links.append(urljoin(url, href))
+        doc.set(a_tag, "href", _LINK_OPEN + href + _LINK_CLOSE)
 
-        while self.queue:
-            url, depth = self.queue.popleft()
-            self._process_page(url, depth)
+    return doc.serialise(), slots, links
 
-        self._rewrite_links()
-        print(f"\nDone – saved {len(self.saved)} files to '{OUTPUT_DIR}/'.")
+
+def _css_template(text: str, base: str, slot) -> str:
+    """
+    Replace every url() and @import reference in CSS *text* with
+    ``slot(asset_url, kind, prefix, suffix, fallback, in_attr)``; @import
+    targets are of kind "css", everything else "binary".
+    """
+    def _ref(m):
+        group = "url" if m.group("url") is not None else "str"
+        ref = m.group(group).strip()
+        if not ref or ref.startswith("data:"):
+            return m.group(0)
+        kind = "css" if group == "str" or m.group("imp") else "binary"
+        text = m.string
+        return slot(urljoin(base, ref), kind, text[m.start():m.start(group)],
+                    text[m.end(group):m.end()], m.group(0), False)
+
+    return _CSS_REF_RE.sub(_ref, text)
+
+
+def _fill_slots(template: str, slots: list[tuple], local_of: dict,
+                page_local: str) -> str:
+    """Replace slot placeholders with relative paths to the saved assets."""
+    def _fill(m):
+        asset_url, _, prefix, suffix, fallback, in_attr = slots[int(m.group(1))]
+        local = local_of.get(asset_url)
+        if not local:
+            return fallback
+        rel = _relative_link(page_local, local)
+        return prefix + (_escape_attr(rel) if in_attr else rel) + suffix
+
+    return _SLOT_RE.sub(_fill, template)
 
 
 # ---------------------------------------------------------------------------
-# Main
+# Frontier and visited set
 # ---------------------------------------------------------------------------
-if __name__ == "__main__":
-    url = sys.argv[1] if len(sys.argv) > 1 else START_URL
+
+class Frontier:
+    """
+    FIFO queue of (url, depth) that keeps at most FRONTIER_MEMORY entries
+    in RAM.
+
+    Entries live in three places, oldest first: the in-memory head that
+    popleft() drains, segment files of FRONTIER_MEMORY // 2 entries
+    each, and the in-memory tail that append() fills. Once anything has
+    spilled, new entries go to the tail; a full tail is written out as
+    the next segment, and an empty head is refilled from the oldest
+    segment (or takes over the tail). Order is exactly that of a deque.
+    Segments are scratch files in a hidden directory under OUTPUT_DIR
+    (the system temp dir is often RAM-backed, which would defeat the
+    point): --resume rebuilds the frontier from the crawl state, not
+    from them.
+    """
+
+    def __init__(self, memory: int | None = None):
+        memory = FRONTIER_MEMORY if memory is None else memory
+        self._segment = max(1, memory // 2)
+        self._head: deque[tuple[str, int]] = deque()
+        self._tail: list[tuple[str, int]] = []
+        self._segments: deque[str] = deque()
+        self._spill_dir: str | None = None
+        self._len = 0
+        self.spilled = 0            # segments written so far
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, item: tuple[str, int]):
+        self._len += 1
+        if not self._segments and not self._tail and len(self._head) < self._segment:
+            self._head.append(item)
+            return
+        self._tail.append(item)
+        if len(self._tail) >= self._segment:
+            self._spill()
+
+    def popleft(self) -> tuple[str, int]:
+        if not self._head:
+            if self._segments:
+                path = self._segments.popleft()
+                with open(path, encoding="utf-8") as fh:
+                    self._head.extend((url, depth) for url, depth in json.load(fh))
+                os.remove(path)
+            else:
+                self._head.extend(self._tail)
+                self._tail = []
+        item = self._head.popleft()     # IndexError when empty, like deque
+        self._len -= 1
+        return item
+
+    def _spill(self):
+        if self._spill_dir is None:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(prefix=".frontier-", dir=OUTPUT_DIR)
+        path = os.path.join(self._spill_dir, f"{self.spilled:08d}.json")
+        with open(path, "w", encoding="utf-8") as fh:
+            json.dump(self._tail, fh, separators=(",", ":"))
+        self._segments.append(path)
+        self._tail = []
+        self.spilled += 1
+
+    def close(self):
+        """Remove any segment files still on disk."""
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._segments.clear()
+
+
+class PriorityFrontier:
+    """
+    Frontier that hands out the shallowest pages first and, within a
+    depth, the highest-scoring ones (key: depth, -score, arrival).
+
+    Depth stays the primary key, so a URL is still first reached at its
+    BFS depth and MAX_DEPTH and the async engine's level barriers mean
+    what they mean for the FIFO frontier; the score only reorders pages
+    of one level (see SiteMirror._priority). Each level keeps up to
+    FRONTIER_MEMORY // 2 entries in a heap; beyond that, (url, score)
+    pairs go to a spilling Frontier in arrival order and are moved into
+    the heap in chunks as it drains, so order is exact only while a
+    level fits in memory. Each URL is scored once, when it arrives.
+    """
+
+    def __init__(self, score, memory: int | None = None):
+        memory = FRONTIER_MEMORY if memory is None else memory
+        self._score = score
+        self._cap = max(1, memory // 2)
+        self._heaps: dict[int, list[tuple[float, int, str]]] = {}
+        self._overflow: dict[int, Frontier] = {}
+        self._seq = count()
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, item: tuple[str, int]):
+        url, depth = item
+        score = self._score(url)
+        self._len += 1
+        heap = self._heaps.setdefault(depth, [])
+        overflow = self._overflow.get(depth)
+        if len(heap) < self._cap and not overflow:
+            heapq.heappush(heap, (-score, next(self._seq), url))
+            return
+        if overflow is None:
+            overflow = self._overflow[depth] = Frontier(self._cap)
+        overflow.append((url, score))
+
+    def popleft(self) -> tuple[str, int]:
+        for depth in sorted(self._heaps):
+            heap = self._heaps[depth]
+            overflow = self._overflow.get(depth)
+            if not heap and overflow:
+                while overflow and len(heap) < self._cap:
+                    url, score = overflow.popleft()
+                    heapq.heappush(heap, (-score, next(self._seq), url))
+            if heap:
+                _, _, url = heapq.heappop(heap)
+                self._len -= 1
+                return url, depth
+        raise IndexError("pop from an empty frontier")
+
+    def close(self):
+        for overflow in self._overflow.values():
+            overflow.close()
+
+
+def _fingerprint(url: str) -> int:
+    """64-bit fingerprint of a normalised URL."""
+    return int.from_bytes(
+        hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class FingerprintSet:
+    """
+    Set of URLs stored as sorted 64-bit fingerprints, ~9 bytes per URL
+    instead of the ~100+ of a set of str.
+
+    New fingerprints collect in a small set and are merged into the
+    sorted array once that set reaches 1/8 of it, so adds are amortised
+    O(1) and lookups a binary search. Two distinct URLs collide with
+    probability about n² / 2**65 — roughly 3 in a million for ten
+    million URLs — and a collision makes the second URL look visited.
+    """
+
+    def __init__(self):
+        self._sorted = array("Q")
+        self._recent: set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def add(self, url: str):
+        fp = _fingerprint(url)
+        if self._has(fp):
+            return
+        self._recent.add(fp)
+        if len(self._recent) >= max(4096, len(self._sorted) // 8):
+            self._sorted = array("Q", heapq.merge(self._sorted, sorted(self._recent)))
+            self._recent.clear()
+
+    def __contains__(self, url: str) -> bool:
+        return self._has(_fingerprint(url))
+
+    def _has(self, fp: int) -> bool:
+        if fp in self._recent:
+            return True
+        i = bisect_left(self._sorted, fp)
+        return i < len(self._sorted) and self._sorted[i] == fp
+
+
+class BloomSet:
+    """
+    Bloom filter sized for BLOOM_CAPACITY URLs at BLOOM_ERROR_RATE.
+
+    Memory is fixed up front: -n·ln(p) / ln(2)² bits, about 1.8 MB per
+    million URLs at p = 0.001. Up to the capacity, a URL that was never
+    added is reported as seen (and so never crawled) with probability p;
+    beyond it the rate climbs quickly, about 1% at twice the capacity.
+    """
+
+    def __init__(self, capacity: int | None = None,
+                 error_rate: float | None = None):
+        capacity = capacity or BLOOM_CAPACITY
+        error_rate = error_rate or BLOOM_ERROR_RATE
+        self._bits = max(64, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self._hashes = max(1, round(self._bits / capacity * math.log(2)))
+        self._array = bytearray((self._bits + 7) // 8)
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _positions(self, url: str):
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * step) % self._bits for i in range(self._hashes)]
+
+    def __contains__(self, url: str) -> bool:
+        return all(self._array[p >> 3] & (1 << (p & 7))
+                   for p in self._positions(url))
+
+    def add(self, url: str):
+        new = False
+        for p in self._positions(url):
+            if not self._array[p >> 3] & (1 << (p & 7)):
+                self._array[p >> 3] |= 1 << (p & 7)
+                new = True
+        self._len += new
+
+
+def _visited_set():
+    """The visited-set implementation selected by VISITED_SET."""
+    if VISITED_SET == "bloom":
+        return BloomSet()
+    if VISITED_SET == "fingerprint":
+        return FingerprintSet()
+    return set()
+
+
+# ---------------------------------------------------------------------------
+# Resumable crawl state
+# ---------------------------------------------------------------------------
+
+class CrawlState:
+    """
+    Durable crawl progress in a SQLite file next to OUTPUT_DIR.
+
+    ``pages`` holds every enqueued page with its depth and a done flag
+    (rowid order is frontier order), ``saved`` the URL -> local path map
+    and, for pages, the URL their relative links resolve against.
+    ``meta`` holds, per URL, what the next run needs for conditional
+    requests (see SiteMirror._remember) as JSON; unlike the other two it
+    outlives the run, so a fresh crawl only starts them over.
+    Updates are buffered and committed in one transaction by checkpoint(),
+    so a crash loses at most the pages finished since the last commit;
+    those are still marked not done and are simply crawled again.
+    """
+
+    def __init__(self, path: str, resume: bool):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS pages (
+                norm  TEXT PRIMARY KEY,
+                url   TEXT NOT NULL,
+                depth INTEGER NOT NULL,
+                done  INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS saved (
+                norm  TEXT PRIMARY KEY,
+                path  TEXT NOT NULL,
+                base  TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                norm  TEXT PRIMARY KEY,
+                entry TEXT NOT NULL
+            );
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(saved)")}
+        if "base" not in columns:       # state file of an older version
+            self._conn.execute("ALTER TABLE saved ADD COLUMN base TEXT")
+        if not resume:
+            with self._conn:
+                self._conn.execute("DELETE FROM pages")
+                self._conn.execute("DELETE FROM saved")
+        self._lock = threading.Lock()
+        self._new_pages: list[tuple[str, str, int]] = []
+        self._new_saved: list[tuple[str, str, str | None]] = []
+        self._done: list[tuple[str]] = []
+        self._new_meta: dict[str, dict] = {}
+
+    def load(self, frontier: Frontier, enqueued) -> dict[str, str]:
+        """
+        Refill *frontier* and *enqueued* as of the last checkpoint and
+        return the saved map.
+        """
+        rows = self._conn.execute(
+            "SELECT norm, url, depth, done FROM pages ORDER BY rowid"
+        )
+        for norm, url, depth, done in rows:
+            enqueued.add(norm)
+            if not done:
+                frontier.append((url, depth))
+        return dict(self._conn.execute("SELECT norm, path FROM saved"))
+
+    def bases(self) -> dict[str, str]:
+        """Local path -> final URL (after redirects) of every saved page."""
+        return dict(self._conn.execute(
+            "SELECT path, base FROM saved WHERE base IS NOT NULL"))
+
+    def add_page(self, norm: str, url: str, depth: int):
+        with self._lock:
+            self._new_pages.append((norm, url, depth))
+
+    def add_saved(self, norm: str, path: str, base: str | None = None):
+        with self._lock:
+            self._new_saved.append((norm, path, base))
+
+    def get_meta(self, norm: str) -> dict | None:
+        """The metadata entry of *norm*, None if it has none."""
+        with self._lock:
+            entry = self._new_meta.get(norm)
+            if entry is None:
+                row = self._conn.execute(
+                    "SELECT entry FROM meta WHERE norm = ?", (norm,)
+                ).fetchone()
+                entry = json.loads(row[0]) if row else None
+        return entry
+
+    def put_meta(self, norm: str, entry: dict):
+        with self._lock:
+            self._new_meta[norm] = entry
+
+    def page_done(self, norm: str) -> bool:
+        """Mark a page finished; True when a checkpoint is due."""
+        with self._lock:
+            self._done.append((norm,))
+            return len(self._done) >= CHECKPOINT_EVERY
+
+    def checkpoint(self):
+        """Commit everything buffered since the last checkpoint."""
+        with self._lock:
+            pages, self._new_pages = self._new_pages, []
+            saved, self._new_saved = self._new_saved, []
+            done, self._done = self._done, []
+            meta, self._new_meta = self._new_meta, {}
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO pages (norm, url, depth) VALUES (?, ?, ?)",
+                    pages,
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO saved (norm, path, base) VALUES (?, ?, ?)",
+                    saved,
+                )
+                self._conn.executemany(
+                    "UPDATE pages SET done = 1 WHERE norm = ?", done
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta (norm, entry) VALUES (?, ?)",
+                    [(norm, json.dumps(entry)) for norm, entry in meta.items()],
+                )
+
+    def close(self):
+        self.checkpoint()
+        self._conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Per-host politeness
+# ---------------------------------------------------------------------------
+
+class _HostState:
+    """Throttle state for one netloc."""
+
+    def __init__(self, delay: tuple[float, float], max_inflight: int):
+        self.delay = delay
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.next_start = 0.0       # monotonic time the next request may start
+        self.blocked_until = 0.0    # monotonic time a Retry-After expires
+        # Adaptive limit (ADAPTIVE_CONCURRENCY), see HostScheduler._adapt
+        self.samples: list[float] = []  # latencies of the current window
+        self.errors = 0             # 4xx / 5xx responses in the current window
+        self.ignore = 0             # responses still due from before a decrease
+        self.base_p50: float | None = None  # lowest window p50 seen
+        self.changes: deque[tuple[float, int, int, str]] = deque(maxlen=20)
+        self.increases = self.decreases = 0
+        # Circuit breaker (BREAKER_FAILURES), see HostScheduler._trip
+        self.failures = 0           # failed requests in a row
+        self.open_until = 0.0       # monotonic time the breaker half-opens
+        self.probing = False        # the one trial request is in flight
+        self.trips = self.refused = 0
+
+
+class HostScheduler:
+    """
+    Hand out request slots per host instead of sleeping globally.
+
+    Every netloc has a one-token bucket that is refilled a random
+    REQUEST_DELAY (or its HOST_DELAYS override) after a request starts
+    and again after it finishes, a cap of HOST_MAX_INFLIGHT concurrent
+    requests, and a Retry-After deadline. With the default cap of 1 a
+    host sees exactly the pacing of the old global sleep, while requests
+    to other hosts (CDNs, font servers …) go ahead without waiting.
+
+    With ADAPTIVE_CONCURRENCY the cap moves per host between 1 and
+    ADAPTIVE_MAX_INFLIGHT (AIMD, see _adapt) and the bucket refill is
+    divided by the cap, so the request rate grows with it.
+
+    A host that fails BREAKER_FAILURES requests in a row is refused for
+    BREAKER_COOLDOWN seconds: acquire() raises HostUnavailable at once
+    instead of letting every page pay the timeouts again.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._hosts: dict[str, _HostState] = {}
+        self._started = time.monotonic()
+
+    def _state(self, host: str) -> _HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            delay = HOST_DELAYS.get(host, REQUEST_DELAY)
+            state = self._hosts[host] = _HostState(delay, HOST_MAX_INFLIGHT)
+        return state
+
+    def _spacing(self, state: _HostState) -> float:
+        spacing = random.uniform(*state.delay)
+        return spacing / state.max_inflight if ADAPTIVE_CONCURRENCY else spacing
+
+    def acquire(self, host: str):
+        """
+        Block until *host* may receive another request; raise
+        HostUnavailable while its circuit breaker is open.
+        """
+        with self._cond:
+            state = self._state(host)
+            while True:
+                now = time.monotonic()
+                if state.open_until and (now < state.open_until or state.probing):
+                    state.refused += 1
+                    raise HostUnavailable(
+                        f"{host} paused after {state.failures} failed requests")
+                ready_at = max(state.next_start, state.blocked_until)
+                if state.inflight < state.max_inflight and now >= ready_at:
+                    break
+                self._cond.wait(ready_at - now if now < ready_at else None)
+            state.inflight += 1
+            state.next_start = now + self._spacing(state)
+            # Past the cooldown: this request is the trial
+            state.probing = bool(state.open_until)
+
+    def release(self, host: str, retry_after: float | None = None,
+                status: int | None = None, latency: float | None = None,
+                failed: bool = False):
+        """
+        Return a slot taken by acquire(), honouring a Retry-After.
+
+        *status* and *latency* (seconds to response headers) feed the
+        adaptive limit; status None means the request raised. *failed*
+        (no usable response: an error, a 5xx or a broken body) feeds the
+        circuit breaker.
+        """
+        with self._cond:
+            state = self._state(host)
+            state.inflight -= 1
+            now = time.monotonic()
+            state.next_start = max(state.next_start, now + self._spacing(state))
+            if retry_after is not None:
+                state.blocked_until = max(state.blocked_until, now + retry_after)
+            if ADAPTIVE_CONCURRENCY:
+                self._adapt(state, status, latency)
+            if BREAKER_FAILURES:
+                self._trip(host, state, failed)
+            self._cond.notify_all()
+
+    def _trip(self, host: str, state: _HostState, failed: bool):
+        """
+        Circuit breaker: any success closes it; BREAKER_FAILURES failures
+        in a row, or a failed trial request, (re)open it for
+        BREAKER_COOLDOWN seconds.
+        """
+        if not failed:
+            state.failures, state.open_until, state.probing = 0, 0.0, False
+            return
+        state.failures += 1
+        if state.probing or state.failures >= BREAKER_FAILURES:
+            state.probing = False
+            state.open_until = time.monotonic() + BREAKER_COOLDOWN
+            state.trips += 1
+            print(f"  [breaker] {host}: {state.failures} failed requests in a "
+                  f"row, pausing it for {BREAKER_COOLDOWN:g}s")
+
+    def breakers(self) -> dict[str, dict[str, int]]:
+        """Hosts whose breaker opened: times opened, requests refused."""
+        with self._cond:
+            return {host: {"opened": state.trips, "refused": state.refused}
+                    for host, state in sorted(self._hosts.items())
+                    if state.trips}
+
+    def _adapt(self, state: _HostState, status: int | None,
+               latency: float | None):
+        """
+        Additive increase, multiplicative decrease of state.max_inflight.
+
+        A 429, 503 or failed request halves the limit at once. Responses
+        from requests that were already in flight at that moment are
+        ignored, so one burst of errors costs one halving. Otherwise
+        latencies are collected in windows of max(limit, 5) responses:
+        a window whose p50 exceeds ADAPTIVE_LATENCY_SPIKE times the
+        lowest window p50 seen halves the limit, and a window of only
+        2xx / 3xx responses raises it by one. A host that is slow even
+        at a limit of 1 gets its baseline reset instead.
+        """
+        if state.ignore:
+            state.ignore -= 1
+            return
+        if status is None or status in (429, 503):
+            self._decrease(state, f"HTTP {status}" if status else "request failed")
+            return
+        if latency is None:
+            return
+        state.samples.append(latency)
+        state.errors += status >= 400
+        if len(state.samples) < max(state.max_inflight, 5):
+            return
+        p50 = sorted(state.samples)[len(state.samples) // 2]
+        errors, state.samples, state.errors = state.errors, [], 0
+        base = state.base_p50
+        # Below ~10 ms (a LAN or localhost) a doubling is just jitter
+        if base is not None and p50 > ADAPTIVE_LATENCY_SPIKE * max(base, 0.01):
+            if state.max_inflight == 1:
+                state.base_p50 = p50
+                return
+            self._decrease(state, f"p50 {p50 * 1000:.0f} ms > "
+                                  f"{ADAPTIVE_LATENCY_SPIKE:g}x {base * 1000:.0f} ms")
+            return
+        state.base_p50 = p50 if base is None else min(base, p50)
+        if errors:
+            return
+        self._set_limit(state, state.max_inflight + 1,
+                        f"stable p50 {p50 * 1000:.0f} ms")
+
+    def _decrease(self, state: _HostState, reason: str):
+        state.ignore = state.inflight
+        self._set_limit(state, state.max_inflight // 2, reason)
+
+    def _set_limit(self, state: _HostState, limit: int, reason: str):
+        limit = max(1, min(limit, ADAPTIVE_MAX_INFLIGHT))
+        state.samples, state.errors = [], 0
+        if limit == state.max_inflight:
+            return
+        if limit > state.max_inflight:
+            state.increases += 1
+        else:
+            state.decreases += 1
+        state.changes.append((time.monotonic() - self._started,
+                              state.max_inflight, limit, reason))
+        state.max_inflight = limit
+
+    def report(self) -> list[str]:
+        """One line per host with its final limit, plus its last changes."""
+        lines = []
+        with self._cond:
+            for host, state in sorted(self._hosts.items()):
+                lines.append(
+                    f"{host}: limit {state.max_inflight} "
+                    f"(+{state.increases} / -{state.decreases})"
+                )
+                lines.extend(f"  {at:8.1f}s  {old} -> {new}  {reason}"
+                             for at, old, new, reason in state.changes)
+        return lines
+
+
+# ---------------------------------------------------------------------------
+# Crawl metrics
+# ---------------------------------------------------------------------------
+
+class Histogram:
+    """Prometheus-style histogram of durations in seconds."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)     # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the q-quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def to_dict(self) -> dict:
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "p50_le": p50 if p50 != math.inf else None,
+                "p95_le": p95 if p95 != math.inf else None}
+
+
+def _prom_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class CrawlMetrics:
+    """
+    Counters and histograms for one run, safe to update from any worker.
+
+    Counters: requests by (host, status) — status "error" when the request
+    raised — bytes received (body bytes as sent on the wire; also kept
+    per host for HOST_BYTE_BUDGET), bytes
+    written under OUTPUT_DIR, urllib3 retries, dedup hits (a requisite
+    already saved or being downloaded by another worker), pages saved,
+    pages skipped because of robots.txt, requisites not requested again
+    because they failed earlier in the run, requests refused by an
+    open circuit breaker and fetches saved by URL canonicalisation (a
+    new spelling of a URL already fetched or queued).
+    Histograms: time to response headers ("latency") and one per
+    SiteMirror._timed phase. The frontier length is kept as a gauge with
+    its peak.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests: dict[tuple[str, str], int] = {}
+        self.host_bytes: dict[str, int] = {}
+        self.counters: dict[str, int] = dict.fromkeys(
+            ("bytes_in", "bytes_out", "retries", "dedup_hits", "pages",
+             "robots_blocked", "negative_hits", "breaker_refused",
+             "canonical_hits"), 0
+        )
+        self.histograms: dict[str, Histogram] = {}
+        self.queue_depth = self.queue_peak = 0
+
+    def inc(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def request(self, host: str, status: int | None, latency: float | None,
+                retries: int, nbytes: int):
+        key = (host, str(status) if status is not None else "error")
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.counters["retries"] += retries
+            self.counters["bytes_in"] += nbytes
+            self.host_bytes[host] = self.host_bytes.get(host, 0) + nbytes
+        if latency is not None:
+            self.observe("latency", latency)
+
+    def queue(self, depth: int):
+        self.queue_depth = depth
+        self.queue_peak = max(self.queue_peak, depth)
+
+    def summary(self) -> dict:
+        """Everything as a JSON-serialisable dict."""
+        with self._lock:
+            by_status: dict[str, int] = {}
+            by_host: dict[str, dict[str, int]] = {}
+            for (host, status), n in sorted(self.requests.items()):
+                by_status[status] = by_status.get(status, 0) + n
+                by_host.setdefault(host, {})[status] = n
+            return {
+                "seconds": round(time.monotonic() - self.started, 3),
+                "requests": sum(by_status.values()),
+                "requests_by_status": by_status,
+                "requests_by_host": by_host,
+                **self.counters,
+                "queue_depth": self.queue_depth,
+                "queue_peak": self.queue_peak,
+                "histograms": {k: h.to_dict()
+                               for k, h in sorted(self.histograms.items())},
+            }
+
+    def progress_line(self, saved: int) -> str:
+        s = self.summary()
+        elapsed = max(s["seconds"], 1e-9)
+        throttled = sum(n for k, n in s["requests_by_status"].items()
+                        if k in ("429", "503"))
+        latency = s["histograms"].get("latency", {}).get("p50_le")
+        return (
+            f"[{elapsed:7.1f}s] pages {s['pages']}  files {saved}  "
+            f"queue {s['queue_depth']}  req {s['requests']} "
+            f"({s['requests'] / elapsed:.1f}/s, {throttled} throttled, "
+            f"{s['retries']} retries)  in {s['bytes_in'] / 1e6:.1f} MB "
+            f"({s['bytes_in'] / elapsed / 1e6:.2f} MB/s)  "
+            f"out {s['bytes_out'] / 1e6:.1f} MB  dedup {s['dedup_hits']}"
+            + (f"  p50 <= {latency * 1000:g} ms" if latency else "")
+        )
+
+    BUCKETS_LE = tuple(f"{b:g}" for b in Histogram.BUCKETS) + ("+Inf",)
+
+    def prometheus(self) -> str:
+        """Node exporter textfile-collector format."""
+        with self._lock:
+            out = ["# TYPE sitemirror_requests_total counter"]
+            out += [f'sitemirror_requests_total{{host="{_prom_label(h)}",'
+                    f'status="{st}"}} {n}'
+                    for (h, st), n in sorted(self.requests.items())]
+            for name, value in self.counters.items():
+                out += [f"# TYPE sitemirror_{name}_total counter",
+                        f"sitemirror_{name}_total {value}"]
+            out += ["# TYPE sitemirror_queue_depth gauge",
+                    f"sitemirror_queue_depth {self.queue_depth}",
+                    "# TYPE sitemirror_seconds_total gauge",
+                    ("sitemirror_seconds_total "
+                     f"{time.monotonic() - self.started:.3f}"),
+                    "# TYPE sitemirror_duration_seconds histogram"]
+            for name, hist in sorted(self.histograms.items()):
+                label = f'kind="{_prom_label(name)}"'
+                cumulative = 0
+                for bound, n in zip(self.BUCKETS_LE, hist.counts):
+                    cumulative += n
+                    out.append(f'sitemirror_duration_seconds_bucket'
+                               f'{{{label},le="{bound}"}} {cumulative}')
+                out += [f"sitemirror_duration_seconds_sum{{{label}}} {hist.sum:.6f}",
+                        f"sitemirror_duration_seconds_count{{{label}}} {hist.count}"]
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Replace *path* atomically so the collector never reads half a file."""
+        with open(path + ".tmp", "w", encoding="utf-8") as fh:
+            fh.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+
+# ---------------------------------------------------------------------------
+# WARC output
+# ---------------------------------------------------------------------------
+
+def _surt(url: str) -> str:
+    """SURT form of *url* for CDX keys: com,example)/path?query."""
+    p = urlparse(url)
+    host = (p.hostname or "").lower()
+    host = host.removeprefix("www.")
+    is_ip = host.replace(".", "").isdigit() or ":" in host
+    key = host if is_ip else ",".join(reversed(host.split(".")))
+    if p.port and p.port not in (80, 443):
+        key += f":{p.port}"
+    path = p.path or "/"
+    return (key + ")" + path + (f"?{p.query}" if p.query else "")).lower()
+
+
+def _warc_digest(digest) -> str:
+    return "sha1:" + base64.b32encode(digest.digest()).decode()
+
+
+class WarcWriter:
+    """
+    Request / response records in rotating, gzip-compressed WARC 1.1 files.
+
+    Files are named <WARC_PREFIX>-<start time>-<nnnnn>.warc.gz inside
+    WARC_DIR; a new one (beginning with a warcinfo record) is started once
+    the current file reaches WARC_MAX_SIZE. Every record is its own gzip
+    member, so a record can be read by seeking to its offset. close()
+    writes <WARC_PREFIX>-<start time>.cdx, a CDX index (sorted by SURT
+    key) giving the file, offset and compressed length of each response.
+
+    Bodies are stored as received on the wire after removing the chunked
+    transfer coding, so Transfer-Encoding is dropped from the recorded
+    headers; Content-Encoding (gzip / deflate) is kept as sent.
+    """
+
+    def __init__(self, directory: str, spent=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Called as spent("write", seconds) for each record written
+        self.spent = spent
+        self._stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        self._lock = threading.Lock()
+        self._fh = None
+        self._name = ""
+        self._seq = 0
+        self._cdx: list[str] = []
+        self.records = 0
+
+    def _open(self):
+        if self._fh is not None:
+            self._fh.close()
+        self._name = f"{WARC_PREFIX}-{self._stamp}-{self._seq:05d}.warc.gz"
+        self._seq += 1
+        self._fh = open(os.path.join(self.directory, self._name), "wb")
+        info = (
+            f"software: download_site.py (requests {requests.__version__})\r\n"
+            "format: WARC File Format 1.1\r\n"
+            "conformsTo: https://iipc.github.io/warc-specifications/"
+            "specifications/warc-format/warc-1.1/\r\n"
+        ).encode()
+        self._write_record(
+            {"WARC-Type": "warcinfo", "WARC-Filename": self._name,
+             "Content-Type": "application/warc-fields"},
+            info, None,
+        )
+
+    def _write_record(self, fields: dict, head: bytes, body) -> tuple[int, int]:
+        """
+        Append one gzip member; *body* is a file object read from its
+        current position. Return (offset, compressed length).
+        """
+        if self._fh is None or (WARC_MAX_SIZE and self._fh.tell() >= WARC_MAX_SIZE):
+            self._open()
+        size = len(head)
+        if body is not None:
+            start = body.tell()
+            body.seek(0, os.SEEK_END)
+            size += body.tell() - start
+            body.seek(start)
+        record = {
+            "WARC-Record-ID": f"<urn:uuid:{uuid.uuid4()}>",
+            "WARC-Date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            **fields,
+            "Content-Length": str(size),
+        }
+        header = "WARC/1.1\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in record.items()
+        ) + "\r\n"
+        offset = self._fh.tell()
+        gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._fh.write(gz.compress(header.encode("utf-8")))
+        self._fh.write(gz.compress(head))
+        if body is not None:
+            while chunk := body.read(DOWNLOAD_CHUNK_SIZE):
+                self._fh.write(gz.compress(chunk))
+        self._fh.write(gz.compress(b"\r\n\r\n") + gz.flush())
+        self.records += 1
+        return offset, self._fh.tell() - offset
+
+    def capture(self, resp: requests.Response) -> int:
+        """
+        Read the body of a stream=True response, record the exchange (and
+        any redirects before it) and make the decoded body readable through
+        resp.raw again. Return the number of body bytes received.
+
+        Raises FileTooLarge past MAX_FILE_SIZE; what was read is recorded
+        with WARC-Truncated.
+        """
+        for hop in resp.history:
+            self._record(hop, io.BytesIO(), None, truncated="unspecified")
+
+        encoding = resp.headers.get("Content-Encoding", "").strip().lower()
+        decoder = (zlib.decompressobj(47) if encoding in ("gzip", "x-gzip")
+                   else zlib.decompressobj() if encoding == "deflate" else None)
+        raw = tempfile.SpooledTemporaryFile(max_size=BLOB_MEMORY_LIMIT)
+        decoded = tempfile.SpooledTemporaryFile(max_size=BLOB_MEMORY_LIMIT) if decoder else raw
+        payload = hashlib.sha1()
+        size = 0
+        truncated = None
+        complete = False
+        try:
+            for chunk in resp.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                size += len(chunk)
+                raw.write(chunk)
+                payload.update(chunk)
+                if decoder is not None:
+                    try:
+                        decoded.write(decoder.decompress(chunk))
+                    except zlib.error:
+                        if encoding != "deflate" or size != len(chunk):
+                            raise
+                        # Some servers send raw deflate instead of zlib data
+                        decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                        decoded.write(decoder.decompress(chunk))
+                if MAX_FILE_SIZE is not None and size > MAX_FILE_SIZE:
+                    truncated = "length"
+                    break
+            else:
+                complete = True
+            if decoder is not None:
+                decoded.write(decoder.flush())
+        finally:
+            if not complete:    # never hand a half-read connection back
+                resp.raw.close()
+            resp.raw.release_conn()
+        raw.seek(0)
+        start = time.perf_counter()
+        self._record(resp, raw, payload, truncated)
+        if self.spent is not None:
+            self.spent("write", time.perf_counter() - start)
+        if decoded is not raw:
+            raw.close()
+        if truncated:
+            decoded.close()
+            raise FileTooLarge(f"over {MAX_FILE_SIZE} bytes")
+        decoded.seek(0)
+        resp.raw = decoded
+        return size
+
+    def _record(self, resp: requests.Response, body, payload, truncated=None):
+        req = resp.request
+        parsed = urlparse(req.url)
+        req_head = f"{req.method} {req.path_url} HTTP/1.1\r\n"
+        req_headers = dict(req.headers)
+        req_headers.setdefault("Host", parsed.netloc)
+        req_head += "".join(f"{k}: {v}\r\n" for k, v in req_headers.items()) + "\r\n"
+
+        raw = resp.raw
+        version = {10: "1.0", 11: "1.1"}.get(getattr(raw, "version", 11), "1.1")
+        items = (raw.headers.items() if hasattr(raw, "headers")
+                 else resp.headers.items())
+        head = f"HTTP/{version} {resp.status_code} {resp.reason}\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in items
+            if k.lower() != "transfer-encoding"
+        ) + "\r\n"
+        head = head.encode("latin-1", "replace")
+        block = hashlib.sha1(head)
+        if payload is None:
+            payload = hashlib.sha1()
+        start = body.tell()
+        while chunk := body.read(DOWNLOAD_CHUNK_SIZE):
+            block.update(chunk)
+        body.seek(start)
+
+        response_id = f"<urn:uuid:{uuid.uuid4()}>"
+        fields = {
+            "WARC-Type": "response",
+            "WARC-Record-ID": response_id,
+            "WARC-Target-URI": req.url,
+            "Content-Type": "application/http; msgtype=response",
+            "WARC-Payload-Digest": _warc_digest(payload),
+            "WARC-Block-Digest": _warc_digest(block),
+        }
+        if truncated:
+            fields["WARC-Truncated"] = truncated
+        with self._lock:
+            offset, length = self._write_record(fields, head, body)
+            name = self._name
+            request_body = req.body or b""
+            if isinstance(request_body, str):
+                request_body = request_body.encode("utf-8")
+            self._write_record(
+                {"WARC-Type": "request", "WARC-Target-URI": req.url,
+                 "WARC-Concurrent-To": response_id,
+                 "Content-Type": "application/http; msgtype=request"},
+                req_head.encode("latin-1", "replace") + request_body, None,
+            )
+            mime = resp.headers.get("Content-Type", "-").split(";")[0].strip() or "-"
+            location = resp.headers.get("Location", "-")
+            self._cdx.append(" ".join((
+                _surt(req.url), time.strftime("%Y%m%d%H%M%S", time.gmtime()),
+                req.url.replace(" ", "%20"), mime.replace(" ", ""),
+                str(resp.status_code), _warc_digest(payload)[5:],
+                urljoin(req.url, location).replace(" ", "%20") if location != "-" else "-",
+                "-", str(length), str(offset), name,
+            )))
+
+    def close(self) -> str | None:
+        """Close the current file and write the CDX index; return its path."""
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            if not self._cdx:
+                return None
+            path = os.path.join(self.directory, f"{WARC_PREFIX}-{self._stamp}.cdx")
+            with open(path, "w", encoding="utf-8") as fh:
+                fh.write(" CDX N b a m s k r M S V g\n")
+                fh.writelines(line + "\n" for line in sorted(self._cdx))
+            self._cdx = []
+            return path
+
+
+# ---------------------------------------------------------------------------
+# HTTP transport
+# ---------------------------------------------------------------------------
+
+class DnsCache:
+    """
+    In-process cache in front of socket.getaddrinfo().
+
+    Both HTTP clients resolve the host again for every new connection;
+    while installed, answers are reused for DNS_CACHE_TTL seconds (0 =
+    always resolve). Failed lookups are not cached. As every lookup is a
+    connection being opened, hits + misses also count connections for the
+    reuse ratio. The patch is process-wide, so install() and uninstall()
+    bracket a run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, tuple[float, list]] = {}
+        self._resolve = None
+        self.hits = self.misses = 0
+
+    def getaddrinfo(self, *args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+        result = self._resolve(*args, **kwargs)
+        if DNS_CACHE_TTL > 0:
+            with self._lock:
+                self._entries[key] = (now + DNS_CACHE_TTL, result)
+        return list(result)
+
+    def install(self):
+        self._resolve = socket.getaddrinfo
+        socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        if socket.getaddrinfo == self.getaddrinfo:
+            socket.getaddrinfo = self._resolve
+
+
+class _DeadlineRetry(Retry):
+    """
+    Retry that gives up instead of sleeping past the deadline of the
+    request in progress on this thread (local.deadline, see
+    RequestsTransport.get). urllib3 then hands back the last response,
+    or raises for a connection error.
+    """
+
+    local = threading.local()
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        new = super().increment(method, url, response, error, _pool, _stacktrace)
+        deadline = getattr(self.local, "deadline", None)
+        if deadline is not None:
+            delay = new.get_backoff_time()
+            if response is not None and new.respect_retry_after_header:
+                retry_after = new.get_retry_after(response)
+                if retry_after is not None:
+                    delay = retry_after
+            if time.monotonic() + delay >= deadline:
+                raise MaxRetryError(_pool, url, DeadlineExceeded(
+                    f"no time left to retry within {REQUEST_DEADLINE}s"))
+        return new
+
+
+def _retry_strategy() -> Retry:
+    """Automatic retry with exponential backoff on 429 / 500 / 502 / 503 / 504."""
+    return _DeadlineRetry(
+        total=5,                        # up to 5 retries per request
+        backoff_factor=1,               # waits 1s, 2s, 4s, 8s, 16s …
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True, # honour Retry-After from server
+        allowed_methods=["GET", "HEAD"],
+        raise_on_status=False,          # hand the last 429/503 to the scheduler
+    )
+
+
+def _pool_size() -> int:
+    # Default: enough pooled connections for every worker of the async engine
+    return POOL_SIZE or max(10, PAGE_WORKERS + ASSET_WORKERS + CSS_WORKERS)
+
+
+class RequestsTransport:
+    """
+    requests / urllib3: HTTP/1.1 with POOL_SIZE pooled connections for
+    each of up to POOL_HOSTS hosts. The default, and the fallback when
+    httpx is not installed.
+    """
+
+    name = "requests"
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            max_retries=_retry_strategy(),
+            pool_connections=POOL_HOSTS,
+            pool_maxsize=_pool_size(),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._versions: dict[str, int] = {}
+
+    def get(self, url: str, deadline: float | None = None,
+            **kwargs) -> requests.Response:
+        with self._lock:
+            self._requests += 1
+        _DeadlineRetry.local.deadline = deadline
+        try:
+            resp = self.session.get(url, **kwargs)
+        finally:
+            _DeadlineRetry.local.deadline = None
+        history = getattr(getattr(resp.raw, "retries", None), "history", ())
+        version = {10: "HTTP/1.0", 11: "HTTP/1.1"}.get(
+            getattr(resp.raw, "version", 11), "HTTP/1.1")
+        with self._lock:
+            self._requests += len(history)
+            self._versions[version] = self._versions.get(version, 0) + 1
+        return resp
+
+    def stats(self) -> dict:
+        """Requests sent (including retries) by HTTP version of the answer."""
+        with self._lock:
+            return {"requests": self._requests,
+                    "http_versions": dict(self._versions)}
+
+    def close(self):
+        self.session.close()
+
+
+class _HttpxRaw:
+    """
+    The part of urllib3's HTTPResponse that requests.Response and this
+    script read from resp.raw, over a streamed httpx response.
+    """
+
+    def __init__(self, resp, retries: Retry):
+        self._resp = resp
+        self.retries = retries
+        self.headers = resp.headers
+        self.version = {"HTTP/1.0": 10, "HTTP/1.1": 11, "HTTP/2": 20}.get(
+            resp.http_version, 11)
+        self._chunks = None
+        self._buffer = bytearray()
+
+    def read(self, amt: int | None = None) -> bytes:
+        """Decoded body bytes, for readers that want a file object."""
+        if self._chunks is None:
+            self._chunks = self.stream(DOWNLOAD_CHUNK_SIZE)
+        while amt is None or len(self._buffer) < amt:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            self._buffer += chunk
+        amt = len(self._buffer) if amt is None else amt
+        data = bytes(self._buffer[:amt])
+        del self._buffer[:amt]
+        return data
+
+    def stream(self, amt: int, decode_content: bool = True):
+        chunks = (self._resp.iter_bytes(amt) if decode_content
+                  else self._resp.iter_raw(amt))
+        try:
+            yield from chunks
+        except httpx.TimeoutException as exc:
+            raise requests.Timeout(exc) from exc
+        except httpx.DecodingError as exc:
+            raise requests.exceptions.ContentDecodingError(exc) from exc
+        except httpx.RequestError as exc:
+            raise requests.exceptions.ChunkedEncodingError(exc) from exc
+
+    def tell(self) -> int:
+        return self._resp.num_bytes_downloaded
+
+    def close(self):
+        self._resp.close()
+
+    def release_conn(self):
+        pass                    # httpx returns the connection on close()
+
+
+class HttpxTransport:
+    """
+    httpx: HTTP/2 when the h2 package is installed, so a host's requests
+    share one multiplexed connection, else HTTP/1.1 keep-alive.
+
+    Responses are handed back as requests.Response objects (body read
+    through _HttpxRaw) and httpx errors as requests exceptions, so callers
+    cannot tell the transports apart. The retry policy is the same
+    urllib3 Retry, applied here. httpx pools are
+    client-wide: up to POOL_HOSTS x POOL_SIZE idle connections are kept
+    for KEEPALIVE_EXPIRY seconds; per-host concurrency is already capped
+    by the HostScheduler.
+    """
+
+    name = "httpx"
+
+    def __init__(self):
+        self.client = httpx.Client(
+            http2=_HAVE_H2,
+            follow_redirects=True,
+            max_redirects=30,
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=POOL_HOSTS * _pool_size(),
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        self._retry = _retry_strategy()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._versions: dict[str, int] = {}
+
+    def get(self, url: str, headers=None, timeout=None,
+            deadline: float | None = None,
+            stream: bool = False) -> requests.Response:
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        request = self.client.build_request(
+            "GET", url, headers=headers,
+            timeout=httpx.Timeout(read, connect=connect),
+        )
+        history: list[RequestHistory] = []
+        while True:
+            started = time.monotonic()
+            with self._lock:
+                self._requests += 1
+            resp = error = None
+            try:
+                resp = self.client.send(request, stream=True)
+            except httpx.TransportError as exc:
+                error = exc
+            except httpx.RequestError as exc:      # too many redirects …
+                raise requests.RequestException(exc) from exc
+            else:
+                retry_after = resp.headers.get("Retry-After")
+                if not self._retry.is_retry("GET", resp.status_code,
+                                            retry_after is not None):
+                    break
+            attempt = RequestHistory("GET", url, error,
+                                     resp.status_code if resp else None, None)
+            delay = self._retry.new(
+                history=tuple(history) + (attempt,)).get_backoff_time()
+            if resp is not None and _parse_retry_after(retry_after) is not None:
+                delay = _parse_retry_after(retry_after)
+            if len(history) >= self._retry.total or (
+                    deadline is not None and time.monotonic() + delay >= deadline):
+                if resp is not None:
+                    break       # like raise_on_status=False: the last answer
+                if isinstance(error, httpx.TimeoutException):
+                    raise requests.Timeout(error) from error
+                raise requests.ConnectionError(error) from error
+            history.append(attempt)
+            if resp is not None:
+                resp.read()     # drain the error body so the connection is kept
+            time.sleep(delay)
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._versions[resp.http_version] = \
+                self._versions.get(resp.http_version, 0) + 1
+
+        out = self._response(resp, self._retry.new(history=tuple(history)))
+        out.elapsed = timedelta(seconds=elapsed)
+        out.history = [self._response(hop, None) for hop in resp.history]
+        if not stream:
+            out.content         # like requests: read the body, free the connection
+        return out
+
+    @staticmethod
+    def _response(resp, retries) -> requests.Response:
+        out = requests.Response()
+        out.status_code = resp.status_code
+        out.reason = resp.reason_phrase
+        out.url = str(resp.url)
+        out.headers = CaseInsensitiveDict(resp.headers.items())
+        out.encoding = get_encoding_from_headers(out.headers)
+        out.raw = _HttpxRaw(resp, retries)
+        req = requests.PreparedRequest()
+        req.method = resp.request.method
+        req.url = str(resp.request.url)
+        req.headers = CaseInsensitiveDict(resp.request.headers.items())
+        req.body = None
+        out.request = req
+        if resp.is_closed:      # redirect hops: body already read
+            out._content = resp.content
+        return out
+
+    def stats(self) -> dict:
+        """Requests sent (including retries) by HTTP version of the answer."""
+        with self._lock:
+            return {"requests": self._requests,
+                    "http_versions": dict(self._versions)}
+
+    def close(self):
+        self.client.close()
+
+
+class _DeadlineRaw:
+    """
+    resp.raw that raises DeadlineExceeded once the request's deadline has
+    passed, checked before each chunk; everything else is passed through.
+    """
+
+    def __init__(self, raw, deadline: float):
+        object.__setattr__(self, "_raw", raw)
+        object.__setattr__(self, "_deadline", deadline)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def _check(self):
+        if time.monotonic() > self._deadline:
+            raise DeadlineExceeded(f"body not received within {REQUEST_DEADLINE}s")
+
+    def stream(self, amt: int, decode_content: bool = True):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._check()
+            yield chunk
+
+    def read(self, *args, **kwargs) -> bytes:
+        self._check()
+        return self._raw.read(*args, **kwargs)
+
+
+def _make_transport():
+    """The TRANSPORT client, falling back to requests without httpx."""
+    if TRANSPORT == "httpx":
+        if httpx is not None:
+            return HttpxTransport()
+        print("  [!] httpx is not installed; using the requests transport")
+    return RequestsTransport()
+
+
+# ---------------------------------------------------------------------------
+# Downloader class
+# ---------------------------------------------------------------------------
+
+class SiteMirror:
+    def __init__(self):
+        # URL rules may have changed since the last mirror was made
+        global _canonicaliser
+        _canonicaliser = None
+
+        # Domains and paths whose pages are followed
+        self.scope = CrawlScope()
+
+        # HTTP client (TRANSPORT) and the DNS cache in front of it
+        self.transport = _make_transport()
+        self.dns = DnsCache()
+
+        # Per-host delays, in-flight caps and Retry-After state
+        self.scheduler = HostScheduler()
+
+        # url  -> local file path   (for everything we saved)
+        self.saved: dict[str, str] = {}
+        # BFS queue: (url, depth), spilling to disk past FRONTIER_MEMORY
+        self.queue = (PriorityFrontier(self._priority)
+                      if FRONTIER_ORDER == "priority" else Frontier())
+        # Scoring state for the priority frontier
+        self._patterns = [(re.compile(rx), w) for rx, w in PRIORITY_PATTERNS]
+        self._host_queued: dict[str, int] = {}
+        # Normalised URLs already enqueued (pages only), see VISITED_SET
+        self.enqueued = _visited_set()
+
+        # Guards queue / enqueued / _inflight when workers run in threads
+        self._lock = threading.Lock()
+        # normalised URL -> Future of an asset download currently running
+        self._inflight: dict[str, Future] = {}
+        # Requisite downloads of the sync engine
+        self._asset_pool = ThreadPoolExecutor(
+            max_workers=ASSET_WORKERS, thread_name_prefix="asset"
+        )
+        # What stylesheets reference, @imports included (see _css_requisites)
+        self._css_pool = ThreadPoolExecutor(
+            max_workers=CSS_WORKERS, thread_name_prefix="css"
+        )
+        # CPU-bound parse / rewrite stage, off the GIL of the fetchers.
+        # Its workers start once fetch threads are running, and fork()ing
+        # a multi-threaded process can deadlock the child: use forkserver
+        # (spawn where there is none)
+        self._parse_pool = None
+        if PARSE_PROCESSES > 0 and ENGINE != "async":
+            print("  [!] PARSE_PROCESSES needs the async engine; parsing in-thread")
+        elif PARSE_PROCESSES > 0:
+            methods = multiprocessing.get_all_start_methods()
+            self._parse_pool = ProcessPoolExecutor(
+                max_workers=PARSE_PROCESSES,
+                mp_context=multiprocessing.get_context(
+                    "forkserver" if "forkserver" in methods else "spawn"),
+            )
+        # Set while the async engine runs; routes assets to its workers
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._asset_queue: asyncio.Queue | None = None
+        # Pages of the current BFS level not yet taken by a page worker
+        self._level_left = 0
+        # Budgets: pages taken from the frontier (in total / per host), the
+        # budget that stopped the crawl, and what was skipped (SKIPPED_FILE)
+        self._pages_taken = 0
+        self._host_pages: dict[str, int] = {}
+        self.stopped_by: str | None = None
+        self.skipped: dict[str, int] = {}
+        self._skipped_fh = None
+        if SKIPPED_FILE:
+            try:
+                os.remove(os.path.join(OUTPUT_DIR, SKIPPED_FILE))
+            except OSError:
+                pass
+
+        # Seconds spent per phase, summed over all workers (see _timed)
+        self.timings: dict[str, float] = dict.fromkeys(
+            ("wait", "fetch", "parse", "write", "relink"), 0.0
+        )
+        # Per-thread stack of time counted under phases nested in the
+        # _timed() blocks still open, to be taken out of theirs
+        self._nested = threading.local()
+        # Request / byte counters and latency histograms for the run report
+        self.metrics = CrawlMetrics()
+        # Raw HTTP exchanges for long-term archiving (WARC_DIR)
+        self.warc = WarcWriter(WARC_DIR, self._spent) if WARC_DIR else None
+
+        # Optional content-addressed store shared by all binary downloads
+        self.blobs = (
+            BlobStore(os.path.join(OUTPUT_DIR, ".blobs"), BLOB_LINK)
+            if BLOB_STORE else None
+        )
+        # Optional single-file output; pages stay on disk only until relinked
+        self.archive = MirrorArchive(ARCHIVE_FILE) if ARCHIVE_FILE else None
+        # Where finished downloads go instead of their OUTPUT_DIR path
+        self._store = self.archive or self.blobs
+
+        # host -> Future of its parsed robots.txt (ROBOTS_TXT), fetched
+        # on first use by whichever worker gets there first
+        self._robots: dict[str, Future] = {}
+        # Sitemap URLs whose <lastmod> predates our copy: reused unfetched
+        self._unchanged = _visited_set()
+        # Requisites that failed this run: not requested again
+        self._failed = _visited_set()
+        # Every URL spelling seen, to count fetches canonicalisation saved
+        self._variants = _visited_set()
+
+        # Frontier, visited set and saved map, checkpointed for --resume
+        state_path = STATE_FILE or OUTPUT_DIR.rstrip("/\\") + ".state.sqlite"
+        self.state = CrawlState(state_path, resume=RESUME)
+        if RESUME:
+            self.saved = self.state.load(self.queue, self.enqueued)
+        self._import_metadata()
+
+        # Saved pages that still contain <a href> placeholders, with the
+        # URL their links are relative to; after a crash any saved page
+        # may, so a resumed run checks all of them
+        bases = self.state.bases() if RESUME else {}
+        self._relink_pending: dict[str, str] = {
+            path: bases.get(path, norm) for norm, path in self.saved.items()
+            if path.endswith(".html")
+        }
+
+    @contextmanager
+    def _timed(self, phase: str):
+        """
+        Add the duration of the with-block to self.timings[phase].
+
+        Time counted under another phase inside the block (a nested
+        _timed() or _spent()) is left out, so the phases never overlap:
+        a body written to disk while it is fetched is "write" only.
+        """
+        stack = getattr(self._nested, "stack", None)
+        if stack is None:
+            stack = self._nested.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = time.perf_counter() - start
+            nested = stack.pop()
+            self._spent(phase, total - nested)
+            if stack:
+                stack[-1] += nested
+
+    def _spent(self, phase: str, seconds: float):
+        """Count *seconds* under *phase* and out of the enclosing _timed()."""
+        stack = getattr(self._nested, "stack", None)
+        if stack:
+            stack[-1] += seconds
+        with self._lock:
+            self.timings[phase] += seconds
+        self.metrics.observe(phase, seconds)
+
+    # ----- per-URL metadata -------------------------------------------------
+
+    def _import_metadata(self):
+        """
+        Move a METADATA_FILE left by an older version into the crawl
+        state, where each entry lives from now on (CrawlState.get_meta).
+        """
+        path = os.path.join(OUTPUT_DIR, METADATA_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                entries = json.load(fh)
+        except (OSError, ValueError):
+            return
+        for norm, entry in entries.items():
+            if self.state.get_meta(norm) is None:
+                self.state.put_meta(norm, entry)
+        self.state.checkpoint()
+        os.remove(path)
+
+    def _remember(self, norm: str, resp: requests.Response, local: str,
+                  size: int, sha256: str, **extra):
+        """Record what a fresh download needs for the next conditional GET."""
+        entry = {
+            "path": local,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "length": size,
+            "sha256": sha256,
+            "fetched": round(time.time()),
+            **extra,
+        }
+        with self._lock:
+            # How often a refetch found new content (see _priority)
+            previous = self.state.get_meta(norm)
+            if previous is not None:
+                entry["checks"] = previous.get("checks", 0) + 1
+                entry["changes"] = (previous.get("changes", 0)
+                                    + (previous.get("sha256") != sha256))
+            self.state.put_meta(norm, entry)
+
+    def _conditional_headers(self, url: str) -> dict[str, str]:
+        """If-None-Match / If-Modified-Since for a file we still have."""
+        # A packed archive is written from scratch, so nothing is kept
+        if not CONDITIONAL_REQUESTS or self.archive is not None:
+            return {}
+        entry = self.state.get_meta(_normalise_url(url))
+        if not entry or not os.path.exists(entry["path"]):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _mark_saved(self, norm: str, local: str, base: str | None = None):
+        self.saved[norm] = local
+        self.state.add_saved(norm, local, base)
+
+    def _reuse(self, url: str) -> str:
+        """Keep the file from an earlier run after a 304 Not Modified."""
+        norm = _normalise_url(url)
+        with self._lock:
+            entry = self.state.get_meta(norm)
+            entry["checks"] = entry.get("checks", 0) + 1
+            self.state.put_meta(norm, entry)
+        local = entry["path"]
+        self._mark_saved(norm, local, entry.get("base"))
+        print(f"  [same]  {url}  ->  {local}")
+        return local
+
+    # ----- throttled request ------------------------------------------------
+
+    @contextmanager
+    def _request(self, url: str, **kwargs):
+        """
+        GET through the per-host scheduler with a rotating User-Agent.
+
+        The host slot is held for the whole with-block, so a body read
+        with stream=True is still downloaded inside the host's budget.
+        URLs saved by an earlier run are requested conditionally; callers
+        treat a 304 as "keep the file on disk" via _reuse().
+
+        CONNECT_TIMEOUT and REQUEST_TIMEOUT apply to each attempt, while
+        REQUEST_DEADLINE bounds the retries and the body download taken
+        together. Failures feed the host's circuit breaker.
+        """
+        host = urlparse(url).netloc.lower()
+        # Per-request header: the session is shared by concurrent workers
+        headers = {"User-Agent": random.choice(USER_AGENTS)}
+        headers.update(self._conditional_headers(url))
+        if self.warc is not None:
+            # Read the raw body here; only encodings zlib can undo
+            headers["Accept-Encoding"] = "gzip, deflate"
+            kwargs["stream"] = True
+        resp = retry_after = status = latency = received = None
+        history = ()
+        failed = False
+        with self._timed("wait"):
+            try:
+                self.scheduler.acquire(host)
+            except HostUnavailable:
+                self.metrics.inc("breaker_refused")
+                raise
+        # Politeness waits above do not count against the deadline
+        deadline = (time.monotonic() + REQUEST_DEADLINE
+                    if REQUEST_DEADLINE is not None else None)
+        timeout = (CONNECT_TIMEOUT, REQUEST_TIMEOUT)
+        if deadline is not None:
+            timeout = tuple(min(t, REQUEST_DEADLINE) for t in timeout)
+        try:
+            with self._timed("fetch"):
+                resp = self.transport.get(
+                    url, headers=headers, timeout=timeout, deadline=deadline,
+                    **kwargs
+                )
+                if deadline is not None:
+                    resp.raw = _DeadlineRaw(resp.raw, deadline)
+                status = resp.status_code
+                latency = resp.elapsed.total_seconds()
+                history = getattr(getattr(resp.raw, "retries", None),
+                                  "history", ())
+                if status in (429, 503):
+                    retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                else:
+                    # A 429 / 503 absorbed by the adapter's retries is
+                    # still an overload signal for the scheduler
+                    throttled = [h.status for h in history
+                                 if h.status in (429, 503)]
+                    if throttled:
+                        status = throttled[-1]
+                if self.warc is not None:
+                    received = self.warc.capture(resp)
+                with resp:
+                    try:
+                        yield resp
+                    finally:
+                        _drain(resp)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            failed = True       # no answer, or a broken / too slow body
+            raise
+        finally:
+            failed = failed or (resp is not None and resp.status_code >= 500)
+            self.scheduler.release(host, retry_after, status, latency, failed)
+            if received is None:
+                tell = getattr(getattr(resp, "raw", None), "tell", None)
+                received = tell() if tell else 0
+            self.metrics.request(
+                host, resp.status_code if resp is not None else None,
+                latency, len(history), received,
+            )
+
+    def _get(self, url: str, **kwargs) -> requests.Response:
+        """
+        GET with the whole body loaded (see _request); FileTooLarge past
+        MAX_FILE_SIZE.
+        """
+        with self._request(url, stream=True, **kwargs) as resp:
+            _read_body(resp)    # inside the host slot
+            return resp
+
+    # ----- asset downloading ------------------------------------------------
+
+    def _fetch_asset(self, url: str, kind: str,
+                     imported_by: str | None = None) -> str | None:
+        """
+        Download a requisite (*kind* is "css" or "binary") exactly once.
+
+        If another worker is already downloading the same URL, wait for
+        its result instead of fetching it a second time — unless this is
+        a stylesheet *imported_by* another one: the worker that has it may
+        be waiting for that importer (an @import cycle), so the path it
+        will be saved at is returned without waiting.
+        """
+        seen_as, url = url, canonical_url(url)
+        norm = _normalise_url(url)
+        with self._lock:
+            self._note_variant(seen_as, norm in self.saved or norm in self._failed
+                               or norm in self._inflight)
+            if norm in self.saved:
+                self.metrics.inc("dedup_hits")
+                return self.saved[norm]
+            if norm in self._failed:
+                self.metrics.inc("negative_hits")
+                return None
+            fut = self._inflight.get(norm)
+            if fut is not None and imported_by is not None:
+                return url_to_local_path(url)
+            if fut is not None:
+                owner = False
+            else:
+                owner = True
+                fut = self._inflight[norm] = Future()
+        if not owner:
+            self.metrics.inc("dedup_hits")
+            return fut.result()
+
+        local = None
+        try:
+            if self._host_over_budget(url):
+                self._skip(url, "host_bytes")
+                self._remember_failure(norm)
+            elif kind == "css":
+                local = self._download_and_rewrite_css(url)
+            else:
+                local = self._download_binary(url)
+        finally:
+            with self._lock:
+                del self._inflight[norm]
+            fut.set_result(local)
+        return local
+
+    def _note_variant(self, seen_as: str, known: bool):
+        """
+        Count a fetch saved by canonicalisation: *seen_as* is a spelling
+        not met before of a URL that is already *known* (caller holds
+        self._lock).
+        """
+        variant = _url_variant(seen_as)
+        if variant in self._variants:
+            return
+        self._variants.add(variant)
+        if known:
+            self.metrics.inc("canonical_hits")
+
+    def _remember_failure(self, norm: str):
+        """
+        Negative cache: a requisite that failed, or was skipped for a
+        budget, is not requested again this run. Refusals by an open
+        circuit breaker are not recorded, so the URL is tried again once
+        its host is back.
+        """
+        with self._lock:
+            self._failed.add(norm)
+
+    def _request_asset(self, url: str, kind: str) -> Future:
+        """
+        Ask for a requisite and return a Future of its local path.
+
+        The sync engine runs it on its asset pool; the async engine hands
+        it to one of its asset workers.
+        """
+        if self._asset_queue is None:
+            return self._asset_pool.submit(self._fetch_asset, url, kind)
+        fut: Future = Future()
+        self._loop.call_soon_threadsafe(
+            self._asset_queue.put_nowait, (url, kind, fut)
+        )
+        return fut
+
+    def _download_binary(self, url: str) -> str | None:
+        """Download a binary asset and return its local path, or None."""
+        norm = _normalise_url(url)
+        if norm in self.saved:
+            return self.saved[norm]
+        local = url_to_local_path(url)
+        try:
+            with self._request(url, stream=True) as resp:
+                if resp.status_code == 304:
+                    return self._reuse(url)
+                resp.raise_for_status()
+                size, sha256 = _stream_to_file(resp, local, self._store,
+                                               self._spent)
+        except FileTooLarge as exc:
+            print(f"  [!] asset too large {url}: {exc}")
+            self._skip(url, "too_large")
+            self._remember_failure(norm)
+            return None
+        except Exception as exc:
+            print(f"  [!] asset error {url}: {exc}")
+            if not isinstance(exc, HostUnavailable):
+                self._remember_failure(norm)
+            return None
+        self.metrics.inc("bytes_out", size)
+        self._remember(norm, resp, local, size, sha256)
+        self._mark_saved(norm, local)
+        print(f"  [asset] {url}  ->  {local}")
+        return local
+
+    # ----- CSS url() / @import rewriting -----------------------------------
+
+    def _download_and_rewrite_css(self, css_url: str) -> str | None:
+        """
+        Download a stylesheet, fetch what it references, save it with the
+        references rewritten.
+
+        Like a page it is parsed once into a template (see _css_template),
+        then everything it references is fetched (_css_requisites) and the
+        slots are filled in one pass.
+        """
+        norm = _normalise_url(css_url)
+        if norm in self.saved:
+            return self.saved[norm]
+        try:
+            resp = self._get(css_url)
+            resp.raise_for_status()
+        except FileTooLarge as exc:
+            print(f"  [!] CSS too large {css_url}: {exc}")
+            self._skip(css_url, "too_large")
+            self._remember_failure(norm)
+            return None
+        except Exception as exc:
+            print(f"  [!] CSS error {css_url}: {exc}")
+            if not isinstance(exc, HostUnavailable):
+                self._remember_failure(norm)
+            return None
+        if resp.status_code == 304:
+            # Unchanged stylesheet: only revalidate what it references
+            self._css_requisites(
+                dict.fromkeys((u, k) for u, k in self.state.get_meta(norm).get("assets", ())),
+                css_url)
+            return self._reuse(css_url)
+
+        css_local = url_to_local_path(css_url)
+        slots: list[tuple] = []
+
+        def _slot(asset_url, kind, *rest) -> str:
+            slots.append((asset_url, kind, *rest))
+            return f"{_SLOT_OPEN}{len(slots) - 1}{_SLOT_CLOSE}"
+
+        with self._timed("parse"):
+            template = _css_template(resp.text, resp.url, _slot)
+        refs = dict.fromkeys((u, kind) for u, kind, *_ in slots)
+        local_of = self._css_requisites(refs, css_url)
+        with self._timed("parse"):
+            text = _fill_slots(template, slots, local_of, css_local)
+        self._save_text(css_local, text)
+        self._remember(norm, resp, css_local, len(resp.content),
+                       hashlib.sha256(resp.content).hexdigest(),
+                       assets=list(refs))
+        self._mark_saved(norm, css_local)
+        print(f"  [css]   {css_url}  ->  {css_local}")
+        return css_local
+
+    def _css_requisites(self, refs, css_url: str) -> dict:
+        """
+        Fetch the (url, kind) pairs a stylesheet references; map each URL
+        to its local path, or None.
+
+        Everything, @imported stylesheets included, is started on the CSS
+        pool at once. A fetch the pool has not started by the time its
+        result is needed is taken back and run in this thread, so a sheet
+        never waits for a worker that is itself waiting (imports nest);
+        @import cycles are cut by _fetch_asset's *imported_by* check.
+        """
+        futures = {}
+        for u, kind in refs:
+            args = (u, kind, css_url if kind == "css" else None)
+            futures[u] = (args, self._css_pool.submit(self._fetch_asset, *args))
+        local_of = {}
+        for u, (args, fut) in futures.items():
+            local_of[u] = self._fetch_asset(*args) if fut.cancel() else fut.result()
+        return local_of
+
+    def _save_text(self, local: str, text: str, on_disk: bool = False):
+        """
+        Save a rewritten page or stylesheet: to *local*, or into the packed
+        archive unless *on_disk* (a page waiting for _rewrite_links()).
+        """
+        with self._timed("write"):
+            data = text.encode("utf-8")
+            if self.archive is not None and not on_disk:
+                self.archive.add(local, None, len(data), data=data)
+            else:
+                _replace_file(local, data)
+        self.metrics.inc("bytes_out", len(data))
+
+    # ----- single page processing -------------------------------------------
+
+    def _process_page(self, url: str, depth: int):
+        """Download an HTML page, its requisites, and enqueue child links."""
+        norm = _normalise_url(url)
+        if norm in self.saved:
+            return
+        if norm in self._unchanged:
+            self._reuse_page(url, depth)
+            return
+        try:
+            with self._request(url, stream=True) as resp:
+                if resp.status_code == 304:
+                    html = None
+                else:
+                    resp.raise_for_status()
+                    content_type = resp.headers.get("Content-Type", "")
+                    if "text/html" not in content_type:
+                        # Not an HTML page — stream it to disk as a binary asset
+                        local = url_to_local_path(url)
+                        size, sha256 = _stream_to_file(
+                            resp, local, self._store, self._spent)
+                        self.metrics.inc("bytes_out", size)
+                        self._remember(norm, resp, local, size, sha256)
+                        self._mark_saved(norm, local)
+                        return
+                    _read_body(resp)
+                    html = resp.text
+        except HostUnavailable:
+            raise                   # not a failed page: see _crawl_page
+        except FileTooLarge as exc:
+            print(f"[!] page too large {url}: {exc}")
+            self._skip(url, "too_large", depth)
+            return
+        except Exception as exc:
+            print(f"[!] page error {url}: {exc}")
+            return
+        if html is None:
+            self._reuse_page(url, depth)
+            return
+
+        page_local = _ensure_html_extension(url_to_local_path(url))
+        # References are relative to where the page really is: canonical
+        # URLs drop the trailing slash the server may redirect back to
+        base_url = resp.url
+        with self._timed("parse"):
+            if self._parse_pool is not None:
+                template, slots, all_links = self._parse_pool.submit(
+                    _analyse_page, base_url, html, PARSER_BACKEND
+                ).result()
+            else:
+                template, slots, all_links = _analyse_page(base_url, html,
+                                                           PARSER_BACKEND)
+
+        # --- 1. Fetch page requisites together -----------------------------
+        #     Every reference is requested before any result is awaited, so
+        #     the page costs as long as its slowest asset, not their sum.
+        pending: dict[str, Future] = {}
+        kinds: dict[str, str] = {}
+        for asset_url, kind, *_ in slots:
+            if asset_url not in pending:
+                kinds[asset_url] = kind
+                pending[asset_url] = self._request_asset(asset_url, kind)
+        local_of = {u: fut.result() for u, fut in pending.items()}
+
+        # --- 2. Fill in local paths now that every download has finished --
+        with self._timed("parse"):
+            text = _fill_slots(template, slots, local_of, page_local)
+
+        # --- 3. Discover and enqueue child links ---------------------------
+        #     Recorded even at MAX_DEPTH so a 304 on a later run can still
+        #     follow them if the page is then reached at a shallower depth.
+        links = []
+        for seen_as in dict.fromkeys(all_links):
+            child_url = canonical_url(seen_as)
+            if self.scope.allows(child_url):
+                links.append(child_url)
+                if depth < MAX_DEPTH:
+                    self._enqueue(child_url, depth + 1, seen_as)
+
+        # --- 4. Save the page -----------------------------------------------
+        #     <a href> placeholders stay until _rewrite_links() runs.
+        self._save_text(page_local, text, on_disk=bool(all_links))
+        self.metrics.inc("pages")
+        if all_links:
+            with self._lock:
+                self._relink_pending[page_local] = base_url
+        body = resp.content
+        self._remember(norm, resp, page_local, len(body),
+                       hashlib.sha256(body).hexdigest(), base=base_url,
+                       links=list(dict.fromkeys(links)),
+                       assets=list(kinds.items()))
+        self._mark_saved(norm, page_local, base_url)
+        print(f"[page]  {url}  ->  {page_local}  (depth={depth})")
+
+    def _reuse_page(self, url: str, depth: int):
+        """
+        Handle a 304 for a page: keep the file from the last run, revalidate
+        the requisites it recorded and follow its recorded links, without
+        downloading or parsing the page again.
+        """
+        entry = self.state.get_meta(_normalise_url(url))
+        futures = [self._request_asset(u, k) for u, k in entry.get("assets", ())]
+        for fut in futures:
+            fut.result()
+        if depth < MAX_DEPTH:
+            for child_url in entry.get("links", ()):
+                # Recorded under the last run's rules, which may differ
+                if self.scope.allows(child_url):
+                    self._enqueue(child_url, depth + 1)
+        local = self._reuse(url)
+        # A run stopped before _rewrite_links() leaves placeholders behind
+        with self._lock:
+            self._relink_pending[local] = entry.get("base") or url
+        self.metrics.inc("pages")
+
+    def _enqueue(self, url: str, depth: int, seen_as: str | None = None) -> bool:
+        """
+        Add a canonical page URL to the frontier unless already seen;
+        True if it was added. *seen_as* is the URL as it was found.
+        """
+        norm = _normalise_url(url)
+        with self._lock:
+            known = norm in self.enqueued
+            self._note_variant(seen_as or url, known)
+            if known:
+                return False
+        # Outside the lock: the first URL of a host fetches its robots.txt
+        if ROBOTS_TXT and not self._robots_allow(url):
+            with self._lock:
+                self.enqueued.add(norm)     # blocked once, not checked again
+            return False
+        with self._lock:
+            if norm in self.enqueued:
+                return False
+            self.enqueued.add(norm)
+            self.queue.append((url, depth))
+            self.state.add_page(norm, url, depth)
+            self.metrics.queue(len(self.queue))
+            return True
+
+    def _crawl_page(self, url: str, depth: int):
+        """Process one frontier entry and record it as done."""
+        self.metrics.queue(len(self.queue))
+        reason = self._host_over_budget(url, page=True)
+        if reason:
+            # Left not done, so a --resume run picks it up again; and not
+            # a page crawled, so it does not count against PAGE_BUDGET
+            with self._lock:
+                self._pages_taken -= 1
+            self._skip(url, reason, depth)
+            return
+        try:
+            self._process_page(url, depth)
+        except HostUnavailable as exc:
+            # Its host's circuit breaker is open: same as a budget skip
+            print(f"[!] page skipped {url}: {exc}")
+            host = urlparse(url).netloc
+            with self._lock:
+                self._pages_taken -= 1
+                self._host_pages[host] = self._host_pages.get(host, 1) - 1
+            self._skip(url, "host_paused", depth)
+            return
+        if self.state.page_done(_normalise_url(url)):
+            self.state.checkpoint()
+
+    # ----- crawl order and budgets ------------------------------------------
+
+    def _priority(self, url: str) -> float:
+        """
+        Score of a page for the priority frontier; higher goes first.
+
+          + the weights of all PRIORITY_PATTERNS the URL matches
+          + PRIORITY_CHANGE_WEIGHT x the share of earlier refetches that
+            found new content (1 for pages we have not seen yet)
+          - PRIORITY_HOST_WEIGHT x log(1 + pages already queued from the
+            same host), so one big host cannot crowd out the others
+        """
+        score = sum(w for rx, w in self._patterns if rx.search(url))
+        entry = self.state.get_meta(_normalise_url(url))
+        if entry is None or not entry.get("checks"):
+            score += PRIORITY_CHANGE_WEIGHT
+        else:
+            score += PRIORITY_CHANGE_WEIGHT * entry.get("changes", 0) / entry["checks"]
+        host = urlparse(url).netloc
+        queued = self._host_queued.get(host, 0)
+        self._host_queued[host] = queued + 1
+        return score - PRIORITY_HOST_WEIGHT * math.log1p(queued)
+
+    def _budget_left(self) -> bool:
+        """
+        False once TIME_BUDGET, BYTE_BUDGET or PAGE_BUDGET is used up;
+        the first one to run out is kept in stopped_by.
+        """
+        if self.stopped_by is None:
+            if TIME_BUDGET is not None and \
+                    time.monotonic() - self.metrics.started >= TIME_BUDGET:
+                self.stopped_by = "time"
+            elif BYTE_BUDGET is not None and \
+                    self.metrics.counters["bytes_in"] >= BYTE_BUDGET:
+                self.stopped_by = "bytes"
+            elif PAGE_BUDGET is not None and self._pages_taken >= PAGE_BUDGET:
+                self.stopped_by = "pages"
+        return self.stopped_by is None
+
+    def _next_page(self) -> tuple[str, int] | None:
+        """
+        Take the next frontier entry; None when empty or out of budget.
+        It counts against PAGE_BUDGET unless _crawl_page turns it down.
+        """
+        with self._lock:
+            if not self.queue or not self._budget_left():
+                return None
+            self._pages_taken += 1
+            return self.queue.popleft()
+
+    def _host_over_budget(self, url: str, page: bool = False) -> str | None:
+        """
+        "host_bytes" / "host_pages" when *url*'s host has used up its
+        HOST_BYTE_BUDGET / HOST_PAGE_BUDGET, else None. With *page* the
+        URL is counted against the host's pages when it is let through.
+        """
+        host = urlparse(url).netloc
+        if HOST_BYTE_BUDGET is not None and \
+                self.metrics.host_bytes.get(host, 0) >= HOST_BYTE_BUDGET:
+            return "host_bytes"
+        if page:
+            with self._lock:
+                taken = self._host_pages.get(host, 0)
+                if HOST_PAGE_BUDGET is not None and taken >= HOST_PAGE_BUDGET:
+                    return "host_pages"
+                self._host_pages[host] = taken + 1
+        return None
+
+    def _skip(self, url: str, reason: str, depth: int | None = None):
+        """Record a URL left out of the mirror in SKIPPED_FILE."""
+        with self._lock:
+            self.skipped[reason] = self.skipped.get(reason, 0) + 1
+            if not SKIPPED_FILE:
+                return
+            if self._skipped_fh is None:
+                os.makedirs(OUTPUT_DIR, exist_ok=True)
+                self._skipped_fh = open(os.path.join(OUTPUT_DIR, SKIPPED_FILE),
+                                        "w", encoding="utf-8")
+            entry = {"url": url, "reason": reason}
+            if depth is not None:
+                entry["depth"] = depth
+            self._skipped_fh.write(json.dumps(entry) + "\n")
+
+    def _skip_frontier(self):
+        """Move what a budget stop left in the frontier to SKIPPED_FILE."""
+        reason = f"{self.stopped_by}_budget"
+        while self.queue:
+            url, depth = self.queue.popleft()
+            self._skip(url, reason, depth)
+
+    # ----- robots.txt and sitemaps ------------------------------------------
+
+    def _robots_for(self, host_url: str) -> RobotFileParser:
+        """
+        The robots.txt of *host_url*'s host, fetched once per run. Only
+        workers that need the same host wait for the fetch.
+        """
+        p = urlparse(host_url)
+        with self._lock:
+            fut = self._robots.get(p.netloc)
+            owner = fut is None
+            if owner:
+                fut = self._robots[p.netloc] = Future()
+        if not owner:
+            return fut.result()
+        robots = RobotFileParser(f"{p.scheme}://{p.netloc}/robots.txt")
+        try:
+            resp = self._get(robots.url)
+            if resp.status_code in (401, 403):
+                robots.disallow_all = True
+            elif resp.ok:
+                robots.parse(resp.text.splitlines())
+            else:               # 404 and friends: no rules
+                robots.allow_all = True
+        except (requests.RequestException, FileTooLarge) as exc:
+            print(f"  [!] robots.txt error {robots.url}: {exc}")
+            robots.allow_all = True
+        finally:
+            fut.set_result(robots)
+        return robots
+
+    def _robots_allow(self, url: str) -> bool:
+        robots = self._robots_for(url)
+        if robots.can_fetch("*", url):
+            return True
+        self.metrics.inc("robots_blocked")
+        return False
+
+    def _seed_from_sitemaps(self, start_url: str):
+        """
+        Enqueue the in-scope URLs of the start host's sitemaps at
+        SITEMAP_DEPTH. Sitemaps come from robots.txt "Sitemap:" lines
+        (else /sitemap.xml); indexes are followed, each file once, and
+        .gz files are decompressed on the fly. A URL whose <lastmod> is
+        older than the copy saved by an earlier run is marked unchanged:
+        _process_page then reuses it without a request.
+        """
+        pending = deque(self._robots_for(start_url).site_maps()
+                        or [urljoin(start_url, "/sitemap.xml")])
+        seen: set[str] = set()
+        files = queued = unchanged = 0
+        while pending:
+            sitemap_url = pending.popleft()
+            if sitemap_url in seen:
+                continue
+            seen.add(sitemap_url)
+            try:
+                with self._request(sitemap_url, stream=True) as resp:
+                    resp.raise_for_status()
+                    body = resp.raw
+                    if hasattr(body, "decode_content"):    # urllib3, not a WARC spool
+                        body.decode_content = True
+                    if urlparse(sitemap_url).path.endswith(".gz") and \
+                            "gzip" not in resp.headers.get("Content-Encoding", ""):
+                        body = gzip.GzipFile(fileobj=body, mode="rb")
+                    files += 1
+                    for kind, loc, lastmod in _iter_sitemap(body):
+                        loc = urljoin(sitemap_url, loc)
+                        if kind == "sitemap":
+                            pending.append(loc)
+                            continue
+                        url = canonical_url(loc)
+                        if not self.scope.allows(url):
+                            continue
+                        norm = _normalise_url(url)
+                        entry = self.state.get_meta(norm)
+                        changed = _parse_lastmod(lastmod)
+                        if (entry and changed is not None
+                                and changed <= entry.get("fetched", 0)
+                                and os.path.exists(entry["path"])):
+                            self._unchanged.add(norm)
+                            unchanged += 1
+                        queued += self._enqueue(url, SITEMAP_DEPTH, loc)
+            except (requests.RequestException, ET.ParseError, OSError) as exc:
+                print(f"  [!] sitemap error {sitemap_url}: {exc}")
+        print(f"Sitemaps: {files} files, {queued} URLs queued, "
+              f"{unchanged} unchanged since the last run.")
+
+    # ----- second pass: convert <a> links -----------------------------------
+
+    def _rewrite_links(self):
+        """
+        After all pages are downloaded, resolve the <a href> placeholders
+        in each saved page: links to a saved URL become relative local
+        paths, all others get their original value back. Files are spliced
+        as bytes, so no page is ever parsed a second time.
+        """
+        print("\n— Rewriting links …")
+        for local_path, base_url in list(self._relink_pending.items()):
+            with open(local_path, "rb") as fh:
+                data = fh.read()
+
+            changed = False
+
+            def _resolve(m):
+                nonlocal changed
+                href = unescape(m.group(1).decode("utf-8"))
+                abs_url = _normalise_url(urljoin(base_url, href))
+                target_local = self.saved.get(abs_url)
+                if not target_local:
+                    return m.group(1)
+                rel = _relative_link(local_path, target_local)
+                if href != rel:
+                    changed = True
+                return _escape_attr(rel).encode("utf-8")
+
+            data, found = _LINK_PLACEHOLDER_RE.subn(_resolve, data)
+            if not found and self.archive is None:
+                continue            # already relinked by an earlier run
+            if self.archive is not None:
+                self.archive.add(local_path, None, len(data), data=data)
+                os.remove(local_path)
+            else:
+                _replace_file(local_path, data)
+            self.metrics.inc("bytes_out", len(data))
+            if changed:
+                print(f"  [relink] {local_path}")
+        self._relink_pending.clear()
+
+    # ----- async engine -----------------------------------------------------
+
+    async def _page_worker(self, executor: ThreadPoolExecutor):
+        """Pull pages of the current BFS level until the level is empty."""
+        loop = asyncio.get_running_loop()
+        while self._level_left > 0:
+            self._level_left -= 1
+            item = self._next_page()
+            if item is None:
+                break
+            await loop.run_in_executor(executor, self._crawl_page, *item)
+
+    async def _asset_worker(self, executor: ThreadPoolExecutor):
+        """Serve asset requests posted by _request_asset."""
+        loop = asyncio.get_running_loop()
+        while True:
+            url, kind, fut = await self._asset_queue.get()
+            try:
+                local = await loop.run_in_executor(
+                    executor, self._fetch_asset, url, kind
+                )
+            except Exception as exc:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(local)
+
+    async def _run_async(self):
+        """
+        Crawl the queue with PAGE_WORKERS page workers and ASSET_WORKERS
+        asset workers.
+
+        Levels are processed one at a time: every page at depth d is done
+        before any page at depth d+1 starts, so a URL is first seen at the
+        same depth as in the sequential BFS and MAX_DEPTH means the same.
+        Blocking work (HTTP, parsing, disk) runs in a thread pool sized so
+        that page threads waiting on assets never starve asset workers.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._asset_queue = asyncio.Queue()
+        executor = ThreadPoolExecutor(max_workers=PAGE_WORKERS + ASSET_WORKERS)
+        asset_tasks = [
+            asyncio.create_task(self._asset_worker(executor))
+            for _ in range(ASSET_WORKERS)
+        ]
+        try:
+            while self.queue and self._budget_left():
+                self._level_left = len(self.queue)
+                await asyncio.gather(
+                    *(self._page_worker(executor) for _ in range(PAGE_WORKERS))
+                )
+        finally:
+            for task in asset_tasks:
+                task.cancel()
+            await asyncio.gather(*asset_tasks, return_exceptions=True)
+            executor.shutdown(wait=True)
+            self._asset_queue = None
+            self._loop = None
+
+    # ----- progress and run report ------------------------------------------
+
+    def _ticker(self, stop: threading.Event):
+        """
+        Every PROGRESS_INTERVAL seconds print a progress line to stderr
+        (redrawn in place on a terminal) and refresh PROMETHEUS_FILE.
+        """
+        tty = sys.stderr.isatty()
+        while not stop.wait(PROGRESS_INTERVAL or 10):
+            self.metrics.queue(len(self.queue))
+            if PROGRESS_INTERVAL:
+                line = self.metrics.progress_line(len(self.saved))
+                sys.stderr.write(f"\r{line}\x1b[K" if tty else line + "\n")
+                sys.stderr.flush()
+            if PROMETHEUS_FILE:
+                self.metrics.write_prometheus(PROMETHEUS_FILE)
+        if tty and PROGRESS_INTERVAL:
+            sys.stderr.write("\n")
+
+    def _report(self, start_url: str) -> dict:
+        """Write SUMMARY_FILE / PROMETHEUS_FILE and return the summary."""
+        self.metrics.queue(len(self.queue))
+        summary = {
+            "start_url": start_url,
+            "files": len(self.saved),
+            **self.metrics.summary(),
+            "stopped_by": self.stopped_by,
+            "skipped": dict(sorted(self.skipped.items())),
+            "phases": {k: round(v, 6) for k, v in self.timings.items()},
+        }
+        if self.blobs is not None:
+            summary["blobs"] = {"files": self.blobs.files,
+                                "duplicates": self.blobs.duplicates,
+                                "bytes_saved": self.blobs.bytes_saved}
+        if ADAPTIVE_CONCURRENCY:
+            summary["concurrency"] = self.scheduler.report()
+        summary["breakers"] = self.scheduler.breakers()
+        transport = summary["transport"] = {
+            "client": self.transport.name,
+            **self.transport.stats(),
+            "connections": self.dns.hits + self.dns.misses,
+            "dns_cache": {"hits": self.dns.hits, "misses": self.dns.misses},
+        }
+        # Share of requests that went out on an already open connection
+        transport["reuse_ratio"] = round(max(
+            0.0, 1 - transport["connections"] / transport["requests"]
+        ), 3) if transport["requests"] else None
+        if SUMMARY_FILE:
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            with open(os.path.join(OUTPUT_DIR, SUMMARY_FILE), "w",
+                      encoding="utf-8") as fh:
+                json.dump(summary, fh, indent=2)
+        if PROMETHEUS_FILE:
+            self.metrics.write_prometheus(PROMETHEUS_FILE)
+        return summary
+
+    # ----- public entry point -----------------------------------------------
+
+    def run(self, start_url: str) -> dict:
+        """Mirror *start_url*; return the run summary (see _report)."""
+        self.dns.install()
+        if RESUME and self.enqueued:
+            print(f"Resuming: {len(self.queue)} pages left, "
+                  f"{len(self.saved)} files already saved.")
+        else:
+            url = canonical_url(start_url)
+            norm = _normalise_url(url)
+            self.enqueued.add(norm)
+            self._variants.add(_url_variant(start_url))
+            self.queue.append((url, 0))
+            self.state.add_page(norm, url, 0)
+            if SITEMAPS:
+                self._seed_from_sitemaps(start_url)
+
+        stop_ticker = threading.Event()
+        if PROGRESS_INTERVAL or PROMETHEUS_FILE:
+            threading.Thread(target=self._ticker, args=(stop_ticker,),
+                             name="progress", daemon=True).start()
+        try:
+            if ENGINE == "async":
+                asyncio.run(self._run_async())
+            else:
+                while (item := self._next_page()) is not None:
+                    self._crawl_page(*item)
+        finally:
+            stop_ticker.set()
+            # Keep progress (and validators) even when interrupted
+            self._asset_pool.shutdown(wait=True)
+            self._css_pool.shutdown(wait=True)
+            if self._parse_pool is not None:
+                self._parse_pool.shutdown(wait=True)
+            self.state.checkpoint()
+            if self.stopped_by is not None:
+                print(f"\n{self.stopped_by} budget used up; {len(self.queue)} "
+                      f"queued pages were not crawled.")
+                self._skip_frontier()
+            if self._skipped_fh is not None:
+                self._skipped_fh.close()
+            self.queue.close()
+            self.transport.close()
+            self.dns.uninstall()
+            if self.warc is not None:
+                cdx = self.warc.close()
+                print(f"\nWARC: {self.warc.records} records in "
+                      f"'{WARC_DIR}/', index {cdx}.")
+            # Also after an interrupt: saved pages hold link placeholders
+            with self._timed("relink"):
+                self._rewrite_links()
+
+        if self.archive is not None:
+            self.archive.close(self.saved.get(_normalise_url(start_url)))
+            # Drop the directories left behind by staged pages
+            for dirpath, _, _ in sorted(os.walk(OUTPUT_DIR), reverse=True):
+                if dirpath != OUTPUT_DIR:
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+            print(f"Archive: {self.archive.files} files, "
+                  f"{self.archive.bytes} bytes in '{ARCHIVE_FILE}'.")
+        self.state.close()
+        print(f"\nDone – saved {len(self.saved)} files to '{OUTPUT_DIR}/'.")
+        if self.blobs is not None:
+            print(f"Blob store: {self.blobs.summary()}.")
+        if ADAPTIVE_CONCURRENCY:
+            print("Per-host concurrency:")
+            for line in self.scheduler.report():
+                print(f"  {line}")
+        summary = self._report(start_url)
+        print(f"Requests: {summary['requests']} "
+              f"{summary['requests_by_status']}, "
+              f"{summary['bytes_in']} bytes in, {summary['bytes_out']} bytes "
+              f"written, {summary['dedup_hits']} dedup hits, "
+              f"{summary['retries']} retries.")
+        if summary["canonical_hits"]:
+            print(f"Canonical URLs: {summary['canonical_hits']} fetches of "
+                  f"duplicate URL variants avoided.")
+        transport = summary["transport"]
+        if transport["requests"]:
+            print(f"Connections ({transport['client']}): "
+                  f"{transport['connections']} opened for "
+                  f"{transport['requests']} requests "
+                  f"({transport['reuse_ratio']:.0%} reused), "
+                  f"{transport['http_versions']}.")
+        if summary["breakers"]:
+            print(f"Paused hosts: {summary['breakers']}.")
+        if self.skipped:
+            print(f"Skipped: {summary['skipped']} (see {SKIPPED_FILE}).")
+        return summary
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recursive website downloader.")
+    parser.add_argument("url", nargs="?", default=START_URL)
+    parser.add_argument("--engine", choices=("sync", "async"), default=ENGINE)
+    parser.add_argument("--domain", action="append", default=[],
+                        help="follow pages on DOMAIN and its subdomains; "
+                             "repeatable (replaces ALLOWED_DOMAINS)")
+    parser.add_argument("--include", action="append", default=[],
+                        metavar="REGEX",
+                        help="only follow pages whose path matches REGEX; repeatable")
+    parser.add_argument("--exclude", action="append", default=[],
+                        metavar="REGEX",
+                        help="do not follow pages whose path matches REGEX; repeatable")
+    parser.add_argument("--page-workers", type=int, default=PAGE_WORKERS)
+    parser.add_argument("--asset-workers", type=int, default=ASSET_WORKERS)
+    parser.add_argument("--parser", default=PARSER_BACKEND,
+                        choices=("auto", "lexbor", "lxml", "stream", "html.parser"))
+    parser.add_argument("--parse-processes", type=int, default=PARSE_PROCESSES,
+                        help="parse pages in N worker processes (0 = in-thread; "
+                             "needs --engine async)")
+    parser.add_argument("--dedup", choices=("hardlink", "symlink"),
+                        help="store identical files once and link to them")
+    parser.add_argument("--resume", action="store_true", default=RESUME,
+                        help="continue the crawl recorded in the state file")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        metavar="SECONDS")
+    parser.add_argument("--read-timeout", type=float, default=REQUEST_TIMEOUT,
+                        metavar="SECONDS")
+    parser.add_argument("--deadline", type=float, default=REQUEST_DEADLINE,
+                        metavar="SECONDS",
+                        help="give up on a request (retries and body included) after SECONDS")
+    parser.add_argument("--breaker-failures", type=int, default=BREAKER_FAILURES,
+                        metavar="N",
+                        help="pause a host after N failed requests in a row (0 = never)")
+    parser.add_argument("--breaker-cooldown", type=float, default=BREAKER_COOLDOWN,
+                        metavar="SECONDS", help="how long a paused host is skipped")
+    parser.add_argument("--transport", choices=("requests", "httpx"),
+                        default=TRANSPORT,
+                        help="HTTP client; httpx speaks HTTP/2 when h2 is installed")
+    parser.add_argument("--pool-size", type=int, default=POOL_SIZE,
+                        help="pooled connections per host")
+    parser.add_argument("--keepalive", type=float, default=KEEPALIVE_EXPIRY,
+                        metavar="SECONDS",
+                        help="keep idle pooled connections this long (httpx)")
+    parser.add_argument("--dns-ttl", type=float, default=DNS_CACHE_TTL,
+                        metavar="SECONDS",
+                        help="cache DNS answers in-process this long (0 = off)")
+    parser.add_argument("--adaptive", action="store_true",
+                        default=ADAPTIVE_CONCURRENCY,
+                        help="tune per-host concurrency from 429/503s and latency")
+    parser.add_argument("--progress", type=float, default=PROGRESS_INTERVAL,
+                        metavar="SECONDS",
+                        help="print a progress line every SECONDS (0 = off)")
+    parser.add_argument("--prometheus", metavar="FILE", default=PROMETHEUS_FILE,
+                        help="write metrics to FILE in Prometheus text format")
+    parser.add_argument("--warc", metavar="DIR", default=WARC_DIR,
+                        help="also write every HTTP exchange to WARC files in DIR")
+    parser.add_argument("--warc-only", action="store_true",
+                        help="with --warc: keep no mirror tree (it is built in a temp dir)")
+    parser.add_argument("--archive", metavar="FILE", default=ARCHIVE_FILE,
+                        help="pack the mirror into one zip FILE instead of a tree")
+    parser.add_argument("--serve", metavar="FILE",
+                        help="serve a mirror packed with --archive and exit")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port for --serve (default: 8000)")
+    parser.add_argument("--robots", action="store_true", default=ROBOTS_TXT,
+                        help="obey robots.txt Disallow rules for pages")
+    parser.add_argument("--sitemaps", action="store_true", default=SITEMAPS,
+                        help="seed the crawl from the start host's sitemaps")
+    parser.add_argument("--visited", choices=("fingerprint", "bloom", "exact"),
+                        default=VISITED_SET,
+                        help="how seen URLs are stored (see VISITED_SET)")
+    parser.add_argument("--order", choices=("fifo", "priority"),
+                        default=FRONTIER_ORDER,
+                        help="crawl order within a depth (see PriorityFrontier)")
+    parser.add_argument("--weight", action="append", default=[],
+                        metavar="REGEX=WEIGHT",
+                        help="with --order priority: raise (or lower) the score "
+                             "of URLs matching REGEX; repeatable")
+    parser.add_argument("--time-budget", type=float, default=TIME_BUDGET,
+                        metavar="SECONDS",
+                        help="stop taking new pages after SECONDS")
+    parser.add_argument("--byte-budget", type=int, default=BYTE_BUDGET,
+                        metavar="BYTES",
+                        help="stop taking new pages after receiving BYTES")
+    parser.add_argument("--page-budget", type=int, default=PAGE_BUDGET,
+                        metavar="N", help="stop after N pages")
+    parser.add_argument("--host-page-budget", type=int, default=HOST_PAGE_BUDGET,
+                        metavar="N", help="crawl at most N pages per host")
+    parser.add_argument("--host-byte-budget", type=int, default=HOST_BYTE_BUDGET,
+                        metavar="BYTES",
+                        help="stop fetching from a host after receiving BYTES from it")
+    parser.add_argument("--max-file-size", type=int, default=MAX_FILE_SIZE,
+                        metavar="BYTES", help="skip files larger than BYTES")
+    parser.add_argument("--frontier-memory", type=int, default=FRONTIER_MEMORY,
+                        help="frontier entries kept in RAM before spilling to disk")
+    args = parser.parse_args()
+    if args.serve:
+        serve_archive(args.serve, args.port)
+        raise SystemExit(0)
+    ENGINE = args.engine
+    if args.domain:
+        ALLOWED_DOMAINS = set(args.domain)
+    SCOPE_INCLUDE += args.include
+    SCOPE_EXCLUDE += args.exclude
+    for rx in SCOPE_INCLUDE + SCOPE_EXCLUDE:
+        try:
+            re.compile(rx)
+        except re.error as exc:
+            parser.error(f"bad --include/--exclude pattern {rx!r}: {exc}")
+    PAGE_WORKERS = args.page_workers
+    ASSET_WORKERS = args.asset_workers
+    RESUME = args.resume
+    PARSER_BACKEND = args.parser
+    PARSE_PROCESSES = args.parse_processes
+    VISITED_SET = args.visited
+    ADAPTIVE_CONCURRENCY = args.adaptive
+    CONNECT_TIMEOUT = args.connect_timeout
+    REQUEST_TIMEOUT = args.read_timeout
+    REQUEST_DEADLINE = args.deadline
+    BREAKER_FAILURES = args.breaker_failures
+    BREAKER_COOLDOWN = args.breaker_cooldown
+    TRANSPORT = args.transport
+    POOL_SIZE = args.pool_size
+    KEEPALIVE_EXPIRY = args.keepalive
+    DNS_CACHE_TTL = args.dns_ttl
+    ROBOTS_TXT = args.robots
+    SITEMAPS = args.sitemaps
+    PROGRESS_INTERVAL = args.progress
+    PROMETHEUS_FILE = args.prometheus
+    FRONTIER_MEMORY = args.frontier_memory
+    FRONTIER_ORDER = args.order
+    for spec in args.weight:
+        pattern, _, weight = spec.rpartition("=")
+        try:
+            PRIORITY_PATTERNS.append((pattern, float(weight)))
+        except ValueError:
+            parser.error(f"--weight expects REGEX=WEIGHT, got {spec!r}")
+    TIME_BUDGET = args.time_budget
+    BYTE_BUDGET = args.byte_budget
+    PAGE_BUDGET = args.page_budget
+    HOST_PAGE_BUDGET = args.host_page_budget
+    HOST_BYTE_BUDGET = args.host_byte_budget
+    MAX_FILE_SIZE = args.max_file_size
+    WARC_DIR = args.warc
+    ARCHIVE_FILE = args.archive
+    if PARSE_PROCESSES and ENGINE != "async":
+        parser.error("--parse-processes needs --engine async")
+    if ARCHIVE_FILE and RESUME:
+        parser.error("--archive cannot --resume (the archive is rebuilt each run)")
+    if args.dedup:
+        BLOB_STORE, BLOB_LINK = True, args.dedup
+    if args.warc_only:
+        if not WARC_DIR or RESUME:
+            parser.error("--warc-only needs --warc and cannot --resume")
+        # The tree is still needed while crawling (links, conditional GETs)
+        OUTPUT_DIR = tempfile.mkdtemp(prefix="sitemirror-tree-")
+        STATE_FILE = os.path.join(OUTPUT_DIR, ".state.sqlite")
+
     mirror = SiteMirror()
-    mirror.run(url)
\ No newline at end of file
+    try:
+        mirror.run(args.url)
+    finally:
+        if args.warc_only:
+            shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
\ No newline at end of file